@@ -0,0 +1,380 @@
+# Copyright 2016 Canonical Limited.  All rights reserved.
+
+# To run: "python bench_collect-logs.py" (or "make bench"), and
+# "python bench_collect-logs.py --fleet" (or "make bench-fleet") for the
+# whole of collect-logs against a simulated fleet (see bench_fleet.py).
+
+from __future__ import print_function
+
+from argparse import ArgumentParser
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+
+script = type(sys)("collect-logs")
+script.__file__ = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "collect-logs"))
+with open(script.__file__) as f:
+    exec(compile(f.read(), script.__file__, "exec"), script.__dict__)
+
+
+STATUS_SIZES = (100, 1000, 5000)
+FLEET_SIZES = (10, 100, 500)
+UNITS_PER_APPLICATION = 10
+CONTAINERS_PER_MACHINE = 4
+FLEET = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                     "bench_fleet.py"))
+# How often the disk used by a fleet run is measured, in seconds.
+DISK_SAMPLE_INTERVAL = 0.1
+
+
+def synthetic_status(units, containers_per_machine=CONTAINERS_PER_MACHINE):
+    """Return a juju 2 status structure holding the given number of units.
+
+    Units are spread over applications of UNITS_PER_APPLICATION units each
+    and placed in containers, containers_per_machine to a machine.  Every
+    principal unit carries a subordinate, and the entries are padded with
+    the fields juju really reports so parsing cost is realistic.
+    """
+    machines = {}
+    applications = {}
+    for index in range(units):
+        machine = str(index // containers_per_machine)
+        container = "{}/lxd/{}".format(
+            machine, index % containers_per_machine)
+        address = "10.{}.{}.{}".format(
+            index // 65536 % 256, index // 256 % 256, index % 256)
+        host = machines.setdefault(machine, {
+            "juju-status": {"current": "started", "version": "2.1.2"},
+            "dns-name": "172.16.{}.{}".format(
+                int(machine) // 256 % 256, int(machine) % 256),
+            "instance-id": "node-{}".format(machine),
+            "machine-status": {"current": "running",
+                               "message": "Deployed"},
+            "series": "xenial",
+            "hardware": "arch=amd64 cores=48 mem=262144M",
+            "containers": {},
+        })
+        host["containers"][container] = {
+            "juju-status": {"current": "started", "version": "2.1.2"},
+            "dns-name": address,
+            "instance-id": "juju-{}".format(container.replace("/", "-")),
+            "machine-status": {"current": "running",
+                               "message": "Container started"},
+            "series": "xenial",
+        }
+        name = "app-{}".format(index // UNITS_PER_APPLICATION)
+        application = applications.setdefault(name, {
+            "charm": "cs:{}-42".format(name),
+            "series": "xenial",
+            "os": "ubuntu",
+            "charm-origin": "jujucharms",
+            "exposed": False,
+            "application-status": {"current": "active"},
+            "relations": {"cluster": [name]},
+            "units": {},
+        })
+        unit_name = "{}/{}".format(name, index % UNITS_PER_APPLICATION)
+        application["units"][unit_name] = {
+            "workload-status": {"current": "active",
+                                "message": "Unit is ready"},
+            "juju-status": {"current": "idle", "version": "2.1.2"},
+            "leader": index % UNITS_PER_APPLICATION == 0,
+            "machine": container,
+            "open-ports": ["80/tcp", "443/tcp"],
+            "public-address": address,
+            "subordinates": {
+                "ntp/{}".format(index): {
+                    "workload-status": {"current": "active"},
+                    "juju-status": {"current": "idle"},
+                    "public-address": address,
+                },
+            },
+        }
+    applications["ntp"] = {
+        "charm": "cs:ntp-17",
+        "subordinate-to": sorted(applications),
+        "units": {},
+    }
+    return {"model": {"name": "default", "version": "2.1.2"},
+            "machines": machines,
+            "applications": applications}
+
+
+def _best_of(func, repeat):
+    """Return the lowest wall time, in seconds, of repeated func() calls."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_status(sizes=STATUS_SIZES, repeat=3):
+    """Time status ingestion, from juju's output to units and hosts."""
+    juju = script.Juju(script.JUJU2)
+    orig_check_output = script.check_output
+    orig_popen = script.Popen
+    print("{:>6} {:>8} {:>10} {:>10} {:>10}".format(
+        "units", "format", "parse", "units", "hosts"))
+    try:
+        for size in sizes:
+            raw = synthetic_status(size)
+            outputs = [
+                ("json", json.dumps(raw, indent=2)),
+                ("yaml", yaml.safe_dump(raw, default_flow_style=False)),
+            ]
+            for output_format, output in outputs:
+                output = output.encode("utf-8")
+                script.Popen = _StatusProcess(output, output_format)
+                script.check_output = lambda *a, **kw: output
+                status = []
+                parse = _best_of(
+                    lambda: status.append(script.get_status(juju)), repeat)
+                raw_status = status[-1].raw
+                units = _best_of(
+                    lambda: script.get_units(juju, raw_status), repeat)
+                hosts = _best_of(
+                    lambda: script.get_hosts(juju, raw_status), repeat)
+                print("{:>6} {:>8} {:>10.4f} {:>10.4f} {:>10.4f}".format(
+                    size, output_format, parse, units, hosts))
+    finally:
+        script.check_output = orig_check_output
+        script.Popen = orig_popen
+
+
+class _StatusProcess(object):
+    """A Popen() stand-in for juju status giving output in output_format.
+
+    Requests for JSON status are rejected like juju 1 does when
+    output_format is YAML, for get_status() to fall back to it.
+    """
+
+    def __init__(self, output, output_format):
+        self.output = output
+        self.output_format = output_format
+
+    def __call__(self, args, **kwargs):
+        self.returncode = 0
+        self.error = b""
+        if self.output_format != "json":
+            self.returncode = 2
+            self.error = (b'error: invalid value "json" for flag --format: '
+                          b'unknown format "json"\n')
+        return self
+
+    def communicate(self):
+        return (b"" if self.returncode else self.output), self.error
+
+
+class FleetJuju(script.Juju):
+    """A Juju whose direct ssh and scp are the fleet's fakes."""
+
+    def __init__(self, bindir, **kwargs):
+        super(FleetJuju, self).__init__(
+            os.path.join(bindir, "juju"), **kwargs)
+        self.bindir = bindir
+
+    def _direct_ssh_args(self, ssh_cmd, unit=None):
+        args = super(FleetJuju, self)._direct_ssh_args(ssh_cmd, unit)
+        args[0] = os.path.join(self.bindir, ssh_cmd)
+        return args
+
+
+def make_fleet(dirname, units, machines, files, file_size, latency,
+               bandwidth):
+    """Set up a simulated fleet in dirname, and return its bin directory.
+
+    The bin directory holds the fleet's juju, ssh and scp, which find the
+    fleet's settings through the BENCH_FLEET environment variable (see
+    bench_fleet.py) set here.
+    """
+    os.makedirs(dirname)
+    containers_per_machine = max(1, -(-units // machines))
+    status = os.path.join(dirname, "status.json")
+    with open(status, "w") as f:
+        json.dump(synthetic_status(units, containers_per_machine), f)
+    config = os.path.join(dirname, "fleet.json")
+    with open(config, "w") as f:
+        json.dump({"dir": os.path.join(dirname, "units"),
+                   "status": status,
+                   "files": files,
+                   "file_size": file_size,
+                   "latency": latency,
+                   "bandwidth": bandwidth}, f)
+    os.environ["BENCH_FLEET"] = config
+    bindir = os.path.join(dirname, "bin")
+    os.mkdir(bindir)
+    for name in ("juju", "ssh", "scp"):
+        path = os.path.join(bindir, name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\nexec \"{}\" \"{}\" {} \"$@\"\n".format(
+                sys.executable, FLEET, name))
+        os.chmod(path, 0o755)
+    return bindir
+
+
+def _disk_usage(dirnames):
+    """Return the bytes taken up by the files under dirnames."""
+    total = 0
+    for dirname in dirnames:
+        for root, _, filenames in os.walk(dirname):
+            for filename in filenames:
+                try:
+                    total += os.lstat(os.path.join(root, filename)).st_size
+                except OSError:
+                    # Removed while walking.
+                    pass
+    return total
+
+
+class DiskSampler(threading.Thread):
+    """Track the peak disk use under dirnames until stopped.
+
+    Only files that have a name are seen, so the spooled members of a
+    bundle, whose temporary files are unlinked right away, aren't.
+    """
+
+    def __init__(self, dirnames):
+        super(DiskSampler, self).__init__()
+        self.daemon = True
+        self.dirnames = dirnames
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, _disk_usage(self.dirnames))
+            self._stop_event.wait(DISK_SAMPLE_INTERVAL)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, _disk_usage(self.dirnames))
+
+
+def _cpu_time(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_fleet(units, machines, files, file_size, latency, bandwidth,
+              options, direct_ssh=False):
+    """Run main() against a simulated fleet of units.
+
+    Return the wall time and CPU time, locally and in the fakes, that it
+    took in seconds, and the peak local disk use and size of the bundle in
+    bytes.
+    """
+    dirname = tempfile.mkdtemp(prefix="bench-fleet-")
+    orig_tempdir = tempfile.tempdir
+    cwd = os.getcwd()
+    try:
+        bindir = make_fleet(os.path.join(dirname, "fleet"), units, machines,
+                            files, file_size, latency, bandwidth)
+        # Everything collect-logs writes locally lands under local.
+        local = os.path.join(dirname, "local")
+        tempfile.tempdir = os.path.join(local, "tmp")
+        os.makedirs(tempfile.tempdir)
+        bundle = os.path.join(local, "logs.tar.gz")
+        juju = FleetJuju(bindir, juju_ssh=not direct_ssh)
+        sampler = DiskSampler([local])
+        sampler.start()
+        cpu = _cpu_time(resource.RUSAGE_SELF)
+        child_cpu = _cpu_time(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        try:
+            script.main(bundle, [], juju, options=options)
+        finally:
+            wall = time.time() - start
+            cpu = _cpu_time(resource.RUSAGE_SELF) - cpu
+            child_cpu = _cpu_time(resource.RUSAGE_CHILDREN) - child_cpu
+            sampler.stop()
+        return wall, cpu, child_cpu, sampler.peak, os.path.getsize(bundle)
+    finally:
+        os.chdir(cwd)
+        tempfile.tempdir = orig_tempdir
+        shutil.rmtree(dirname)
+
+
+def bench_fleet(sizes=FLEET_SIZES, machines=None, files=10,
+                file_size=64 * 1024, latency=0.05, bandwidth=0,
+                options=None, direct_ssh=False):
+    """Time whole collect-logs runs against simulated fleets."""
+    print("{:>6} {:>9} {:>9} {:>10} {:>12} {:>12}".format(
+        "units", "wall", "cpu", "fake cpu", "peak disk", "bundle"))
+    for size in sizes:
+        wall, cpu, child_cpu, peak, bundle = run_fleet(
+            size, machines or -(-size // CONTAINERS_PER_MACHINE), files,
+            file_size, latency, bandwidth, options, direct_ssh)
+        print("{:>6} {:>9.2f} {:>9.2f} {:>10.2f} {:>12} {:>12}".format(
+            size, wall, cpu, child_cpu, peak, bundle))
+
+
+def get_option_parser():
+    parser = ArgumentParser(description="Benchmark collect-logs.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="How many times to repeat each measurement.")
+    parser.add_argument("--units", type=int, nargs="+",
+                        default=list(STATUS_SIZES),
+                        help="The status sizes, in units, to benchmark.")
+    fleet = parser.add_argument_group(
+        "fleet", "Run collect-logs as a whole against simulated units.")
+    fleet.add_argument("--fleet", action="store_true", default=False,
+                       help="Benchmark collect-logs against a simulated "
+                       "fleet instead of status ingestion.")
+    fleet.add_argument("--fleet-units", type=int, nargs="+",
+                       default=list(FLEET_SIZES),
+                       help="The fleet sizes, in units, to benchmark.")
+    fleet.add_argument("--machines", type=int,
+                       help="How many machines the units are spread over, "
+                       "{} units to a machine by default.".format(
+                           CONTAINERS_PER_MACHINE))
+    fleet.add_argument("--files", type=int, default=10,
+                       help="How many log files each unit has.")
+    fleet.add_argument("--file-size", type=script.parse_size,
+                       default=64 * 1024,
+                       help="The size of each log file.")
+    fleet.add_argument("--latency", type=float, default=0.05,
+                       help="The seconds each ssh or scp takes to start.")
+    fleet.add_argument("--bandwidth", type=script.parse_size, default=0,
+                       help="The bytes per second each unit sends or "
+                       "receives, 0 for no limit.")
+    fleet.add_argument("--jobs", "-j", type=int, default=script.DEFAULT_JOBS,
+                       help="collect-logs' --jobs.")
+    fleet.add_argument("--stream", action="store_true", default=False,
+                       help="collect-logs' --stream.")
+    fleet.add_argument("--single-session", action="store_true",
+                       default=False,
+                       help="collect-logs' --single-session.")
+    fleet.add_argument("--direct-ssh", action="store_true", default=False,
+                       help="Use ssh and scp directly rather than through "
+                       "juju, as the command line does.")
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_option_parser().parse_args(sys.argv[1:])
+    # get_status() warns about the YAML fallback on every run, and main()
+    # logs every step of every unit.
+    script.log.disabled = True
+    if args.fleet:
+        bench_fleet(args.fleet_units, args.machines, args.files,
+                    args.file_size, args.latency, args.bandwidth,
+                    script.CollectOptions(
+                        args.jobs, args.stream,
+                        single_session=args.single_session),
+                    args.direct_ssh)
+    else:
+        bench_status(args.units, args.repeat)
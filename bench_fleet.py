@@ -0,0 +1,320 @@
+# Copyright 2016 Canonical Limited.  All rights reserved.
+
+# A fake juju, ssh and scp serving a simulated fleet of units, for
+# "python bench_collect-logs.py --fleet" to collect from.  It is installed
+# under those names as "bench_fleet.py juju|ssh|scp ARGS...", and reads
+# the fleet's settings from the JSON file named by $BENCH_FLEET.
+
+from __future__ import print_function
+
+import gzip
+import io
+import json
+import os
+import random
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+
+
+# The settings of the fleet, which bench_collect-logs.py writes:
+#   dir: where the units' file systems live, one directory per unit
+#   status: the file holding the status "juju status" shows
+#   files, file_size: how many log files each unit has, of what size
+#   latency: the seconds every command takes to get going
+#   bandwidth: the bytes per second units send and receive, 0 for no limit
+ENV_VAR = "BENCH_FLEET"
+
+# Every COMPRESSED_EVERY'th log file is a rotated, gzipped one.
+COMPRESSED_EVERY = 4
+# How many distinct lines each unit's log files are made of.
+LINES_PER_UNIT = 1000
+CHUNK_SIZE = 64 * 1024
+WORDS = ("connection", "established", "closed", "request", "handled", "in",
+         "ms", "unit", "agent", "hook", "config-changed", "update-status",
+         "relation", "joined", "departed", "error", "retrying", "ok", "GET",
+         "POST", "/api/v2/status", "200", "404", "500", "worker", "started",
+         "stopped", "lease", "renewed", "expired", "leader", "elected")
+
+# What collect-logs --session frames its header with, and how it compresses
+# its archive for each codec.
+FRAME_MAGIC = "COLLECT-LOGS-FRAME "
+SESSION_COMPRESSORS = {"gzip": "gzip", "none": None,
+                       "pigz": ["pigz", "-c"], "zstd": ["zstd", "-q", "-c"]}
+
+# The remote commands collect-logs bounds with a deadline.
+TIMEOUT_RE = re.compile(r"^timeout -k \d+ \d+ sh -c (.*)$", re.S)
+# The remote commands running a copy of collect-logs the unit may not have.
+HELPER_RE = re.compile(r"^test -f (\S+) \|\| exit (\d+); (.*)$", re.S)
+TAR_RE = re.compile(r" (-c|-cz|--update -)f (\S+)")
+COMPRESS_PROGRAM_RE = re.compile(r"--use-compress-program='([^']*)'")
+
+
+def load_config():
+    with open(os.environ[ENV_VAR]) as f:
+        return json.load(f)
+
+
+def unit_root(config, target):
+    """Return the directory standing for the file system of target."""
+    root = os.path.join(config["dir"], target.replace("/", "-"))
+    if not os.path.isdir(os.path.join(root, "tmp")):
+        try:
+            os.makedirs(os.path.join(root, "tmp"))
+        except OSError:
+            # Another command to the same unit got there first.
+            pass
+    return root
+
+
+class ThrottledFile(object):
+    """A file written to no faster than bandwidth bytes per second."""
+
+    def __init__(self, fileobj, bandwidth):
+        self._fileobj = fileobj
+        self._bandwidth = bandwidth
+        self._start = time.time()
+        self._written = 0
+
+    def write(self, data):
+        for offset in range(0, len(data), CHUNK_SIZE):
+            chunk = data[offset:offset + CHUNK_SIZE]
+            self._fileobj.write(chunk)
+            self._written += len(chunk)
+            if self._bandwidth:
+                ahead = (self._written / float(self._bandwidth) -
+                         (time.time() - self._start))
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def flush(self):
+        self._fileobj.flush()
+
+
+def _log_lines(rng, name):
+    """Return the distinct log lines of a unit, different for each rng."""
+    lines = []
+    stamp = 1488378600
+    for _ in range(LINES_PER_UNIT):
+        stamp += rng.randint(0, 5)
+        lines.append("{} {} {}[{}]: {}\n".format(
+            stamp, name, rng.choice(WORDS), rng.randint(100, 30000),
+            " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))))
+    return lines
+
+
+def _log_text(rng, lines, size):
+    """Return size bytes of the given log lines, in rng's order."""
+    # Picking whole lines keeps generating files cheap, so the fakes'
+    # CPU time doesn't drown collect-logs' own.
+    text = []
+    length = 0
+    while length < size:
+        line = rng.choice(lines)
+        text.append(line)
+        length += len(line)
+    return "".join(text)[:size].encode("ascii")
+
+
+def unit_files(config, target):
+    """Yield the (path, data) of the log files of target."""
+    lines = _log_lines(random.Random(target), target)
+    for index in range(config["files"]):
+        rng = random.Random("{}:{}".format(target, index))
+        data = _log_text(rng, lines, config["file_size"])
+        if index % COMPRESSED_EVERY == COMPRESSED_EVERY - 1:
+            compressed = io.BytesIO()
+            with gzip.GzipFile(fileobj=compressed, mode="wb", mtime=0) as f:
+                f.write(data)
+            yield ("var/log/app/app.log.{}.gz".format(index),
+                   compressed.getvalue())
+        else:
+            yield "var/log/app/app-{}.log".format(index), data
+
+
+def write_archive(config, target, fileobj, gzipped=False):
+    """Write the archive of target's log files to fileobj."""
+    mode = "w|gz" if gzipped else "w|"
+    tar = tarfile.open(fileobj=fileobj, mode=mode)
+    for path, data in unit_files(config, target):
+        info = tarfile.TarInfo(path)
+        info.size = len(data)
+        info.mtime = 1488378600
+        tar.addfile(info, io.BytesIO(data))
+    tar.close()
+
+
+def _stdout():
+    return getattr(sys.stdout, "buffer", sys.stdout)
+
+
+def stream_archive(config, target, compressor):
+    """Write target's archive to stdout, compressed with compressor.
+
+    compressor is None, "gzip" for gzip in-process, or a program's args.
+    """
+    out = ThrottledFile(_stdout(), config["bandwidth"])
+    if compressor is None or compressor == "gzip":
+        write_archive(config, target, out, gzipped=compressor == "gzip")
+        out.flush()
+        return 0
+    process = subprocess.Popen(
+        compressor, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    writer = threading.Thread(target=_write_and_close, args=(
+        config, target, process.stdin))
+    writer.start()
+    _pump(process.stdout, out)
+    writer.join()
+    return process.wait()
+
+
+def _write_and_close(config, target, fileobj):
+    try:
+        write_archive(config, target, fileobj)
+    finally:
+        fileobj.close()
+
+
+def _pump(source, target):
+    while True:
+        data = source.read(CHUNK_SIZE)
+        if not data:
+            break
+        target.write(data)
+    target.flush()
+
+
+def session(config, target, command):
+    """Stream target's archive as collect-logs --session does."""
+    if "--input" in command:
+        getattr(sys.stdin, "buffer", sys.stdin).read()
+    codec = command.split("--codec ", 1)[1].split()[0]
+    header = json.dumps({"steps": {"ps": 0, "manifest": 0},
+                         "diagnostics": [], "codec": codec, "level": None})
+    out = _stdout()
+    out.write("{}{}\n{}".format(
+        FRAME_MAGIC, len(header), header).encode("ascii"))
+    out.flush()
+    return stream_archive(config, target, SESSION_COMPRESSORS[codec])
+
+
+def ssh(config, target, command):
+    """Run command as if on target, and return its exit code."""
+    time.sleep(config["latency"])
+    match = TIMEOUT_RE.match(command)
+    if match:
+        command = shlex.split(match.group(1))[0]
+    root = unit_root(config, target)
+    match = HELPER_RE.match(command)
+    if match:
+        helper, missing, command = match.groups()
+        if not os.path.exists(os.path.join(root, helper.lstrip("/"))):
+            return int(missing)
+    if "--session" in command:
+        return session(config, target, command)
+    if "--agent" in command:
+        compressor = None
+        if "| " in command:
+            compressor = command.rsplit("| ", 1)[1].split()
+            if compressor[0] == "gzip":
+                compressor = "gzip"
+        return stream_archive(config, target, compressor)
+    match = TAR_RE.search(command)
+    if match and " tar " in " " + command:
+        flags, archive = match.groups()
+        if archive == "-":
+            compressor = None
+            if flags == "-cz":
+                compressor = "gzip"
+            program = COMPRESS_PROGRAM_RE.search(command)
+            if program:
+                compressor = program.group(1).split() + ["-c"]
+            return stream_archive(config, target, compressor)
+        path = os.path.join(root, archive.lstrip("/"))
+        with open(path, "wb") as f:
+            write_archive(config, target, f)
+        return 0
+    if "/var/log/" in command or "apt-get" in command:
+        # ps, the memory footprint and the manifest only write to the
+        # unit's logs.
+        return 0
+    # Whatever is left (compressing, sizing, reading and removing files in
+    # /tmp, installing the helper, probing for programs) runs for real on
+    # the unit's directory, as whoever runs the benchmark.
+    command = command.replace("sudo ", "").replace(" -o root -g root", "")
+    for path in ("/tmp/", "/var/lib/"):
+        command = command.replace(
+            path, os.path.join(root, path.strip("/")) + "/")
+    process = subprocess.Popen(["sh", "-c", command], stdout=subprocess.PIPE)
+    _pump(process.stdout, ThrottledFile(_stdout(), config["bandwidth"]))
+    return process.wait()
+
+
+def scp(config, source, target):
+    """Copy between the local file system and a unit's."""
+    time.sleep(config["latency"])
+    if ":" in source:
+        remote, path = source.split(":", 1)
+        path = os.path.join(
+            unit_root(config, remote.split("@")[-1]), path.lstrip("/"))
+        if os.path.isdir(target):
+            target = os.path.join(target, os.path.basename(path))
+        if not os.path.exists(path):
+            return 1
+        with open(path, "rb") as src:
+            with open(target, "wb") as dst:
+                _pump(src, ThrottledFile(dst, config["bandwidth"]))
+        return 0
+    remote, path = target.split(":", 1)
+    path = os.path.join(
+        unit_root(config, remote.split("@")[-1]), path.lstrip("/"))
+    with open(source, "rb") as src:
+        with open(path, "wb") as dst:
+            _pump(src, ThrottledFile(dst, config["bandwidth"]))
+    return 0
+
+
+def _strip_options(args):
+    """Return args without their leading ssh options and -m MODEL."""
+    args = list(args)
+    while args and args[0] in ("-o", "-i", "-m", "--"):
+        del args[:1 if args[0] == "--" else 2]
+    return args
+
+
+def juju(config, args):
+    if args[0] == "status":
+        with open(config["status"], "rb") as f:
+            shutil.copyfileobj(f, _stdout())
+        return 0
+    if args[0] == "ssh":
+        rest = _strip_options(args[1:])
+        return ssh(config, rest[0], rest[-1])
+    if args[0] == "scp":
+        return scp(config, args[-2], args[-1])
+    print("bench_fleet: unsupported juju command: {}".format(args),
+          file=sys.stderr)
+    return 2
+
+
+def main(argv):
+    config = load_config()
+    name, args = argv[0], argv[1:]
+    if name == "juju":
+        return juju(config, args)
+    if name == "ssh":
+        rest = _strip_options(args)
+        return ssh(config, rest[0].split("@")[-1], rest[-1])
+    if name == "scp":
+        return scp(config, args[-2], args[-1])
+    print("bench_fleet: unknown program {}".format(name), file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
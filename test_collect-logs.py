@@ -2,15 +2,24 @@
 
 # To run: "python -m unittest test_collect-logs"
 
+from contextlib import closing
 import errno
+import hashlib
 from fixtures import EnvironmentVariableFixture, TestWithFixtures
+import io
+import json
 import os
 import os.path
 import shutil
+import stat
 import subprocess
 import sys
+import tarfile
 import tempfile
-from unittest import TestCase
+import threading
+import time
+from unittest import TestCase, skipUnless
+import zipfile
 
 import mock
 
@@ -43,7 +52,7 @@ def _create_file(filename, data=None):
 
     with open(filename, "w") as file:
         if data:
-            file.write()
+            file.write(data)
 
 
 class _BaseTestCase(TestCase):
@@ -138,6 +147,776 @@ class GetUnitsTests(TestCase):
             expected, script.get_units(juju=None, status=status))
 
 
+class JujuStatusTests(TestCase):
+
+    STATUS = {
+        "machines": {
+            "0": {"dns-name": "1.2.3.3"},
+            "1": {"dns-name": "1.2.3.4",
+                  "containers": {"1/lxd/0": {"dns-name": "10.0.0.2"}}}},
+        "applications": {
+            "ubuntu": {
+                "units": {"ubuntu/1": {"public-address": "1.2.3.4",
+                                       "machine": "1"}}},
+            "ntp": {
+                "units": {"ntp/1": {"public-address": "10.0.0.2",
+                                    "machine": "1/lxd/0"}}}},
+    }
+
+    def setUp(self):
+        super(JujuStatusTests, self).setUp()
+        self.orig_check_output = script.check_output
+        self.output = json.dumps(self.STATUS)
+        script.check_output = mock.Mock(
+            return_value=self.output.encode("utf-8"))
+        patcher = mock.patch.object(script, "Popen")
+        self.process = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.process.returncode = 0
+        self.process.communicate.return_value = (
+            self.output.encode("utf-8"), b"")
+
+    def tearDown(self):
+        script.check_output = self.orig_check_output
+        super(JujuStatusTests, self).tearDown()
+
+    def test_get_status_runs_juju_status_once(self):
+        """
+        get_status() runs "juju status" once, as JSON, and every lookup on
+        the snapshot reuses its result.
+        """
+        juju = script.Juju()
+
+        status = script.get_status(juju)
+        status.units
+        status.hosts
+        status.bootstrap_ip
+        status.unit_machines
+
+        script.Popen.assert_called_once_with(
+            ["juju", "status", "--format=json"], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, env=None)
+        script.check_output.assert_not_called()
+        self.assertEqual(self.output, status.output)
+        self.assertEqual(self.STATUS, status.raw)
+        self.assertEqual("juju-status.json", status.filename)
+
+    def test_get_status_falls_back_to_yaml(self):
+        """
+        get_status() asks for YAML, parsed with the fastest safe loader,
+        when the juju binary can't produce JSON.
+        """
+        juju = script.Juju()
+        self.process.returncode = 2
+        self.process.communicate.return_value = (
+            b"", b'error: invalid value "json" for flag --format: '
+            b'unknown format "json"\n')
+        script.check_output.return_value = b"machines: {}"
+
+        with mock.patch.object(script.yaml, "load") as load:
+            load.return_value = {"machines": {}}
+            status = script.get_status(juju)
+
+        script.check_output.assert_called_once_with(
+            ["juju", "status", "--format=yaml"], env=None)
+        load.assert_called_once_with(
+            "machines: {}", Loader=script.YAML_LOADER)
+        self.assertEqual({"machines": {}}, status.raw)
+        self.assertEqual("juju-status.yaml", status.filename)
+
+    def test_get_status_error(self):
+        """
+        get_status() doesn't hide other failures of juju status behind a
+        second, YAML, attempt.
+        """
+        self.process.returncode = 1
+        self.process.communicate.return_value = (
+            b"", b"ERROR connection is shut down\n")
+
+        with self.assertRaises(subprocess.CalledProcessError) as raised:
+            script.get_status(script.Juju())
+
+        self.assertEqual("ERROR connection is shut down",
+                         raised.exception.output)
+        script.check_output.assert_not_called()
+
+    def test_get_status_warnings(self):
+        """
+        What juju writes to stderr is logged, and doesn't get in the way of
+        parsing its JSON.
+        """
+        self.process.communicate.return_value = (
+            self.output.encode("utf-8"), b"WARNING juju is old\n")
+
+        with mock.patch.object(script.log, "warning") as warning:
+            status = script.get_status(script.Juju())
+
+        warning.assert_called_once_with("juju status: WARNING juju is old")
+        self.assertEqual(self.STATUS, status.raw)
+        script.check_output.assert_not_called()
+
+    def test_helpers_accept_snapshot(self):
+        """
+        get_units(), get_hosts() and get_bootstrap_ip() answer from a
+        JujuStatus without running "juju status" again.
+        """
+        status = script.JujuStatus(script.Juju(), self.STATUS)
+
+        self.assertItemsEqual(
+            [script.JujuUnit("ubuntu/1", "1.2.3.4"),
+             script.JujuUnit("ntp/1", "10.0.0.2")],
+            script.get_units(None, status))
+        self.assertItemsEqual(
+            [script.JujuHost("0", "1.2.3.3"),
+             script.JujuHost("1", "1.2.3.4")],
+            script.get_hosts(None, status))
+        self.assertEqual("1.2.3.3", script.get_bootstrap_ip(None, status))
+        script.check_output.assert_not_called()
+
+    def test_units_are_copies(self):
+        """
+        Callers may extend the returned units list without changing the
+        snapshot.
+        """
+        status = script.JujuStatus(script.Juju(), self.STATUS)
+
+        status.units.append(script.JujuUnit("0", "1.2.3.3"))
+
+        self.assertEqual(2, len(status.units))
+
+    def test_unit_machines(self):
+        """
+        unit_machines maps each unit, and the bootstrap pseudo-unit, to
+        its machine.
+        """
+        status = script.JujuStatus(script.Juju(), self.STATUS)
+
+        self.assertEqual(
+            {"0": "0", "ubuntu/1": "1", "ntp/1": "1/lxd/0"},
+            status.unit_machines)
+
+    def test_list_models(self):
+        """list_models() returns the controller's models, with owners."""
+        script.check_output.return_value = json.dumps({"models": [
+            {"name": "admin/default", "short-name": "default"},
+            {"name": "admin/controller", "short-name": "controller"}],
+            }).encode("utf-8")
+        juju = script.Juju("juju-2.1", model="default")
+
+        models = script.list_models(juju)
+
+        self.assertEqual(["admin/controller", "admin/default"], models)
+        script.check_output.assert_called_once_with(
+            ["juju-2.1", "models", "--format=json"], env=None)
+
+    def test_save(self):
+        """
+        save() writes the status output exactly as juju reported it.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, "juju-status.yaml")
+        status = script.JujuStatus(script.Juju(), self.STATUS, "the: status")
+
+        status.save(filename)
+
+        with open(filename) as f:
+            self.assertEqual("the: status", f.read())
+
+
+class EngineTests(TestCase):
+
+    def test_runs_all_tasks(self):
+        """Engine.run() runs every submitted task once."""
+        done = []
+        engine = script.Engine(jobs=3)
+        for i in range(10):
+            engine.submit(done.append, i)
+
+        engine.run()
+
+        self.assertEqual(list(range(10)), sorted(done))
+
+    def test_jobs_limit(self):
+        """No more than "jobs" tasks run at the same time."""
+        lock = threading.Lock()
+        state = {"running": 0, "most": 0}
+
+        def task():
+            with lock:
+                state["running"] += 1
+                state["most"] = max(state["most"], state["running"])
+            time.sleep(0.01)
+            with lock:
+                state["running"] -= 1
+
+        engine = script.Engine(jobs=2)
+        for _ in range(8):
+            engine.submit(task)
+
+        engine.run()
+
+        self.assertEqual(2, state["most"])
+
+    def test_tasks_may_submit_tasks(self):
+        """Tasks submitted by running tasks are run too."""
+        done = []
+        engine = script.Engine(jobs=2)
+        engine.submit(lambda: engine.submit(done.append, "child"))
+
+        engine.run()
+
+        self.assertEqual(["child"], done)
+
+    def test_error(self):
+        """
+        An error from a task is re-raised by run(), and no further tasks are
+        started.
+        """
+        done = []
+        engine = script.Engine(jobs=1)
+        engine.submit(done.append, 1)
+        engine.submit(mock.Mock(side_effect=FakeError()))
+        engine.submit(done.append, 2)
+
+        with self.assertRaises(FakeError):
+            engine.run()
+
+        self.assertEqual([1], done)
+
+    def test_key_limits(self):
+        """
+        No more tasks using the same key run at once than their kind's
+        limit, and tasks held back by a key let later ones go first.
+        """
+        started = []
+        a_started = threading.Event()
+        other_started = threading.Event()
+
+        def task(name):
+            if name == "c":
+                # Only record "c" once "a" is, whichever worker is faster.
+                a_started.wait(5)
+            started.append(name)
+            if name == "a":
+                a_started.set()
+                # "b" can't start until "a" is done, but "c" can.
+                other_started.wait(5)
+            elif name == "c":
+                other_started.set()
+
+        engine = script.Engine(jobs=2, limits={"machine": 1})
+        engine.submit_using([("machine", "1")], task, "a")
+        engine.submit_using([("machine", "1")], task, "b")
+        engine.submit_using([("machine", "2")], task, "c")
+
+        engine.run()
+
+        self.assertEqual(["a", "c", "b"], started)
+
+
+class DeadlineTests(TestCase):
+
+    def setUp(self):
+        super(DeadlineTests, self).setUp()
+        patcher = mock.patch.object(script.time, "time", return_value=1000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.juju = script.Juju(script.JUJU2, juju_ssh=True)
+        self.unit = script.JujuUnit("haproxy/0", "1.2.3.4")
+
+    def test_parse_duration(self):
+        """Durations are in seconds, or with an s, m, h or d suffix."""
+        self.assertEqual(90, script.parse_duration("90"))
+        self.assertEqual(90, script.parse_duration("90s"))
+        self.assertEqual(600, script.parse_duration("10m"))
+        self.assertEqual(7200, script.parse_duration("2h"))
+        for value in ["", "soon", "0", "-1m"]:
+            with self.assertRaises(script.ArgumentTypeError):
+                script.parse_duration(value)
+
+    def test_options_args(self):
+        """
+        The inner collect-logs gets the unit timeout, and its share of the
+        time left as its deadline.
+        """
+        options = script.CollectOptions(unit_timeout=120, deadline=1600)
+
+        self.assertEqual(["--unit-timeout", "120s", "--deadline", "480s"],
+                         options.args())
+
+    def test_collection_deadline(self):
+        """Collection stops early enough to finish the bundle."""
+        self.assertEqual(
+            1570, script.CollectOptions(deadline=1600).collection_deadline())
+        self.assertEqual(
+            1090, script.CollectOptions(deadline=1100).collection_deadline())
+        self.assertIsNone(script.CollectOptions().collection_deadline())
+
+    def test_bounded_commands(self):
+        """
+        Within a deadline, commands are bounded by it both locally and on
+        the unit.
+        """
+        timeout = ["timeout", "-k", "5", "60"]
+        with script.deadline_scope(1060):
+            self.assertEqual(
+                timeout + ["juju-2.1", "ssh", "haproxy/0",
+                           "timeout -k 5 60 sh -c 'ps fauxww | sudo tee f'"],
+                self.juju.ssh_args(self.unit, "ps fauxww | sudo tee f"))
+            self.assertEqual(
+                timeout + ["juju-2.1", "scp", "haproxy/0:f", "."],
+                self.juju.pull_args(self.unit, "f"))
+        self.assertEqual(["juju-2.1", "ssh", "haproxy/0", "ls"],
+                         self.juju.ssh_args(self.unit, "ls"))
+
+    def test_nested_scopes(self):
+        """Nested scopes can't push the deadline back."""
+        with script.deadline_scope(1010):
+            with script.deadline_scope(1060):
+                self.assertEqual(10, script._time_left())
+            with script.deadline_scope(1005):
+                self.assertEqual(5, script._time_left())
+
+    def test_deadline_passed(self):
+        """No more commands are built once the deadline has passed."""
+        with script.deadline_scope(1000):
+            with self.assertRaises(script.DeadlineExceeded):
+                self.juju.ssh_args(self.unit, "ls")
+
+    def test_cleanup_scope(self):
+        """
+        Cleaning up gets CLEANUP_TIMEOUT seconds past the deadline, and
+        the deadline is back afterwards.
+        """
+        with script.deadline_scope(1000):
+            with script.cleanup_scope():
+                self.assertEqual(
+                    "timeout -k 5 10 sh -c ls",
+                    self.juju.ssh_args(self.unit, "ls")[-1])
+            with self.assertRaises(script.DeadlineExceeded):
+                self.juju.ssh_args(self.unit, "ls")
+        with script.cleanup_scope():
+            self.assertEqual("ls", self.juju.ssh_args(self.unit, "ls")[-1])
+
+    def test_download_out_of_time(self):
+        """
+        A download running out of time isn't taken for a failure, and the
+        unit's tarball is still removed.
+        """
+        with mock.patch.object(script, "pull_file") as pull_file, \
+                mock.patch.object(script, "call", return_value=0) as call, \
+                mock.patch.object(script.log, "warning") as warning:
+            pull_file.side_effect = script.DeadlineExceeded()
+            with script.deadline_scope(1000):
+                with self.assertRaises(script.DeadlineExceeded):
+                    script.download_log_from_unit(self.juju, self.unit)
+
+        warning.assert_not_called()
+        call.assert_called_once_with(
+            ["timeout", "-k", "5", "10", "juju-2.1", "ssh", "haproxy/0",
+             "timeout -k 5 10 sh -c 'sudo rm -f /tmp/logs_haproxy-0.tar.gz'"],
+            env=None)
+
+    def test_summary(self):
+        """
+        Units are recorded as complete, incomplete when they run out of
+        time, or skipped when the deadline passed before they started.
+        """
+        summary = script.RunStats(deadline=1100, unit_timeout=30)
+        seen = []
+
+        def collect():
+            seen.append(script._time_left())
+            raise script.DeadlineExceeded()
+
+        summary.run(["a/0"], lambda: None)
+        summary.run(["b/0", "b/1"], collect)
+        script.time.time.return_value = 1100
+        summary.run(["c/0"], seen.append, "started")
+
+        self.assertEqual([30], seen)
+        self.assertEqual(
+            {"a/0": "complete", "b/0": "incomplete", "b/1": "incomplete",
+             "c/0": "skipped"},
+            dict((name, unit["state"])
+                 for name, unit in summary.units.items()))
+        self.assertEqual(["b/0", "b/1", "c/0"], summary.unfinished())
+
+
+class RunStatsTests(TestCase):
+
+    def setUp(self):
+        super(RunStatsTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.stats = script.RunStats()
+
+    def _collect(self, seconds, bytes_in):
+        """Pretend to collect a unit, spending seconds in ps."""
+        with mock.patch.object(script.time, "time",
+                               side_effect=[0, seconds]):
+            with script._phase("ps"):
+                pass
+        script._count("bytes_in", bytes_in)
+
+    def test_save(self):
+        """
+        The units' phases and counters are saved, with their totals and
+        the phases of the run.
+        """
+        self.stats.run(["a/0"], self._collect, 2, 100)
+        self.stats.run(["b/0"], self._collect, 3, 50)
+        self.stats.record_phase("status", 1.5)
+        filename = os.path.join(self.tmpdir, script.STATS_FILENAME)
+
+        self.stats.save(filename)
+
+        with open(filename) as f:
+            stats = json.load(f)
+        self.assertEqual({"ps": 2}, stats["units"]["a/0"]["phases"])
+        self.assertEqual(50, stats["units"]["b/0"]["bytes_in"])
+        self.assertEqual("complete", stats["units"]["b/0"]["state"])
+        self.assertEqual(
+            {"retries": 0, "bytes_resent": 0, "bytes_in": 150,
+             "bytes_out": 0, "throttled": 0, "phases": {"ps": 5}},
+            stats["totals"])
+        self.assertEqual({"status": 1.5}, stats["phases"])
+
+    def test_failed(self):
+        """
+        A unit whose collection raises an unexpected error is recorded as
+        failed, and the error doesn't stop the run.
+        """
+        def collect():
+            script._count("bytes_in", 10)
+            raise FakeError()
+
+        with mock.patch.object(script.log, "warning") as warning:
+            self.stats.run(["a/0"], collect)
+        self.stats.run(["b/0"], self._collect, 1, 0)
+
+        warning.assert_called_once_with(
+            "Collecting a/0 failed, continuing: FakeError()")
+        self.assertEqual("failed", self.stats.units["a/0"]["state"])
+        self.assertEqual(10, self.stats.units["a/0"]["bytes_in"])
+        self.assertEqual("complete", self.stats.units["b/0"]["state"])
+        self.assertEqual(["a/0"], self.stats.unfinished())
+
+    def test_outside_units(self):
+        """Steps run outside of a unit's collection aren't counted."""
+        self._collect(1, 10)
+
+        self.assertEqual({}, self.stats.units)
+
+    def test_log_summary(self):
+        """The slowest units and phases are logged, slowest first."""
+        self.stats.run(["a/0"], self._collect, 2, 0)
+        self.stats.run(["b/0"], self._collect, 3, 0)
+        for unit, seconds in (("a/0", 2), ("b/0", 3)):
+            self.stats.units[unit]["seconds"] = seconds
+        self.stats.record_phase("status", 1)
+
+        with mock.patch.object(script.log, "info") as info:
+            self.stats.log_summary(count=1)
+
+        self.assertEqual(
+            [mock.call("Slowest units: b/0 3.0s"),
+             mock.call("Slowest unit phases, over all units: ps 5.0s"),
+             mock.call("Run phases: status 1.0s")],
+            info.call_args_list)
+
+
+class LowImpactTests(TestCase):
+
+    def setUp(self):
+        super(LowImpactTests, self).setUp()
+        patcher = mock.patch.object(script.time, "time", return_value=1000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(script.time, "sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.juju = script.Juju(script.JUJU2, juju_ssh=True)
+        self.unit = script.JujuUnit("haproxy/0", "1.2.3.4")
+
+    def test_options(self):
+        """
+        --low-impact keeps transfers to the default rates unless given
+        others, and the inner collect-logs gets them too.
+        """
+        parser = script.get_option_parser()
+        options = script.CollectOptions.from_args(parser.parse_args(
+            ["--low-impact", "--total-rate", "2M", "logs.tgz"]))
+
+        self.assertTrue(options.low_impact)
+        self.assertEqual(script.LOW_IMPACT_UNIT_RATE, options.unit_rate)
+        self.assertEqual(2 * 1024 ** 2, options.total_rate)
+        self.assertEqual(
+            ["--low-impact", "--unit-rate", "1048576",
+             "--total-rate", "2097152"], options.args())
+        options = script.CollectOptions.from_args(
+            parser.parse_args(["logs.tgz"]))
+        self.assertIsNone(options.unit_rate)
+        self.assertIsNone(options.total_rate)
+
+    def test_low_priority(self):
+        """
+        Remote commands run at the lowest priority, within their deadline.
+        """
+        self.juju.low_priority = True
+        self.assertEqual(
+            ["juju-2.1", "ssh", "haproxy/0",
+             "nice -n 19 ionice -c 2 -n 7 sh -c 'sudo tar -cf - /var/log'"],
+            self.juju.ssh_args(self.unit, "sudo tar -cf - /var/log"))
+        with script.deadline_scope(1060):
+            self.assertEqual(
+                "nice -n 19 ionice -c 2 -n 7 timeout -k 5 60 sh -c ls",
+                self.juju.ssh_args(self.unit, "ls")[-1])
+
+    def test_scp_rate(self):
+        """scp keeps to the transfer rate, in Kbit/s."""
+        self.juju.transfer_rate = 1024 ** 2
+        self.assertEqual(
+            ["juju-2.1", "scp", "--", "-l", "8192", "haproxy/0:f", "."],
+            self.juju.pull_args(self.unit, "f"))
+        juju = script.Juju(script.JUJU2, juju_ssh=False)
+        juju.transfer_rate = 100
+        self.assertEqual(
+            ["-l", "1", "f", "ubuntu@1.2.3.4:/tmp/f"],
+            juju.push_args(self.unit, "f", "/tmp/f")[-4:])
+
+    def test_throttle(self):
+        """
+        A Throttle's budget is shared by all its transfers, and recovers
+        with time, keeping up to a second's worth for bursts.
+        """
+        throttle = script.Throttle(100)
+
+        self.assertEqual(0, throttle.charge(60))
+        self.assertEqual(0.5, throttle.charge(90))
+        self.assertEqual(1, throttle.charge(50))
+        script.time.time.return_value = 1010
+        self.assertEqual(0, throttle.charge(100))
+        self.assertEqual(0.5, throttle.charge(50))
+
+    def test_throttled(self):
+        """
+        Units wait for both their own budget and the run's, and the time
+        they were held back is in the stats.  What scp copied only counts
+        against the run's budget.
+        """
+        stats = script.RunStats(unit_rate=100, total_rate=400)
+
+        def collect(amount, scp=False):
+            script._throttle(amount, scp)
+
+        stats.run(["a/0"], collect, 300)
+        stats.run(["b/0"], collect, 300, True)
+        stats.run(["c/0"], script._CountedFile(io.BytesIO(b"x" * 150)).read)
+
+        self.assertEqual(
+            [mock.call(2), mock.call(0.5), mock.call(0.875)],
+            self.sleep.call_args_list)
+        self.assertEqual(
+            {"a/0": 2, "b/0": 0.5, "c/0": 0.875},
+            dict((name, unit["throttled"])
+                 for name, unit in stats.units.items()))
+        self.assertEqual(3.375, stats.totals()["throttled"])
+
+    def test_throttled_deadline(self):
+        """Units aren't held back past their deadline."""
+        stats = script.RunStats(deadline=1001, unit_rate=100)
+
+        stats.run(["a/0"], script._throttle, 500)
+
+        self.sleep.assert_called_once_with(1)
+
+
+class CodecTests(TestCase):
+
+    def test_gzip_commands(self):
+        """gzip without a level keeps the plain commands."""
+        codec = script.CODECS["gzip"]
+
+        self.assertEqual("sudo gzip -f /tmp/logs.tar",
+                         codec.format_compress_file("/tmp/logs.tar"))
+        self.assertEqual("-czf", codec.tar_create_flags())
+        self.assertEqual(["tar", "-C", "unit", "-xzf", "logs.tar.gz"],
+                         codec.tar_extract_args("unit", "logs.tar.gz"))
+
+    def test_level(self):
+        """The level is passed to the program, clamped to its maximum."""
+        codec = script.CODECS["pigz"].at_level(12)
+
+        self.assertEqual("sudo pigz -9 -f /tmp/logs.tar",
+                         codec.format_compress_file("/tmp/logs.tar"))
+        self.assertEqual("--use-compress-program='pigz -9' -cf",
+                         codec.tar_create_flags())
+
+    def test_zstd_commands(self):
+        """zstd runs multi-threaded and is decompressed by tar."""
+        codec = script.CODECS["zstd"].at_level(3)
+
+        self.assertEqual(".zst", codec.extension)
+        self.assertEqual("sudo zstd -q -T0 -3 -f --rm /tmp/logs.tar",
+                         codec.format_compress_file("/tmp/logs.tar"))
+        self.assertEqual(
+            ["tar", "-C", "unit", "--use-compress-program=zstd", "-xf",
+             "logs.tar.zst"],
+            codec.tar_extract_args("unit", "logs.tar.zst"))
+
+    def test_none_commands(self):
+        """The "none" codec leaves archives uncompressed."""
+        codec = script.CODECS["none"]
+
+        self.assertEqual("", codec.extension)
+        self.assertEqual("-cf", codec.tar_create_flags())
+        self.assertEqual(["tar", "-C", "unit", "-xf", "logs.tar"],
+                         codec.tar_extract_args("unit", "logs.tar"))
+
+    def test_options_args(self):
+        """The codec and level are passed on to the inner collect-logs."""
+        options = script.CollectOptions(compress="zstd", compress_level=3)
+
+        self.assertEqual(["--compress", "zstd", "--compress-level", "3"],
+                         options.args())
+        self.assertEqual(3, options.codec.level)
+
+
+class TimeWindowTests(TestCase):
+
+    def test_parse_date(self):
+        """parse_time() takes local dates, with or without a time."""
+        self.assertEqual(
+            time.mktime((2017, 3, 1, 14, 30, 0, 0, 0, -1)),
+            script.parse_time("2017-03-01 14:30"))
+        self.assertEqual(
+            time.mktime((2017, 3, 1, 0, 0, 0, 0, 0, -1)),
+            script.parse_time("2017-03-01"))
+        self.assertEqual(
+            time.mktime((2017, 3, 1, 14, 30, 15, 0, 0, -1)),
+            script.parse_time("2017-03-01T14:30:15"))
+
+    def test_parse_duration(self):
+        """parse_time() takes durations before now."""
+        self.assertEqual(100000 - 6 * 3600,
+                         script.parse_time("6h", now=100000))
+        self.assertEqual(100000 - 90 * 60,
+                         script.parse_time("90m", now=100000))
+        self.assertEqual(100000 - 2 * 86400,
+                         script.parse_time("2d", now=100000))
+
+    def test_parse_epoch(self):
+        """parse_time() takes seconds since the epoch."""
+        self.assertEqual(1488378600, script.parse_time("@1488378600"))
+
+    def test_parse_invalid(self):
+        """Invalid times are rejected as invalid arguments."""
+        for value in ["yesterday", "6x", "@now", ""]:
+            with self.assertRaises(script.ArgumentTypeError):
+                script.parse_time(value)
+
+    def test_tar_command_window(self):
+        """
+        With a window, find picks the files modified in it, and the ones
+        always collected, for tar to archive.
+        """
+        cmd = script._format_tar_command("-cf", "-", since=100, until=200)
+
+        self.assertTrue(cmd.startswith(
+            "sudo find $(sudo sh -c \"ls -1d /var/log /etc/hosts "))
+        self.assertIn(
+            " ! -type d \\( -path '/etc/*' -o "
+            "-path '/var/log/ps-fauxww.txt' -o -path '/var/log/ps_mem.txt' "
+            "-o -path '/var/log/collect-logs-manifest.txt' "
+            "-o \\( -newermt @100 ! -newermt @200 \\) \\) -print0 "
+            "2>/dev/null | sudo tar --ignore-failed-read ", cmd)
+        self.assertTrue(cmd.endswith(
+            "--exclude=/var/lib/juju/containers/juju-*-lxc-template "
+            "--null -T - -cf -"))
+
+    def test_tar_command_since(self):
+        """Only the given bounds are applied."""
+        cmd = script._format_tar_command("-cf", "-", since=100)
+
+        self.assertIn("-o \\( -newermt @100 \\) \\)", cmd)
+
+    def test_options_args(self):
+        """The window is passed on to the inner collect-logs as is."""
+        options = script.CollectOptions(since=100, until=200)
+
+        self.assertEqual(["--since", "@100", "--until", "@200"],
+                         options.args())
+
+
+class ChooseUnitCodecTests(TestCase):
+
+    def setUp(self):
+        super(ChooseUnitCodecTests, self).setUp()
+        self.juju = script.Juju(script.JUJU2)
+        self.unit = script.JujuUnit("haproxy/0", "1.2.3.4")
+        patcher = mock.patch.object(script, "check_output")
+        self.check_output = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(script, "_which", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_gzip_not_probed(self):
+        """Units aren't checked for gzip, which is always there."""
+        codec = script.choose_unit_codec(
+            self.juju, self.unit, script.CODECS["gzip"])
+
+        self.assertEqual("gzip", codec.name)
+        self.check_output.assert_not_called()
+
+    def test_available(self):
+        """A codec found on the unit is used."""
+        self.check_output.return_value = b"/usr/bin/zstd\n/usr/bin/pigz\n"
+
+        codec = script.choose_unit_codec(
+            self.juju, self.unit, script.CODECS["zstd"].at_level(5))
+
+        self.assertEqual("zstd", codec.name)
+        self.assertEqual(5, codec.level)
+        self.check_output.assert_called_once_with(
+            self.juju.ssh_args(
+                self.unit,
+                "for c in zstd pigz; do command -v $c; done; true"),
+            stderr=subprocess.STDOUT, env=self.juju.env)
+
+    def test_fallback(self):
+        """Units missing the codec fall back to the next one they have."""
+        self.check_output.return_value = b"/usr/bin/pigz\n"
+
+        codec = script.choose_unit_codec(
+            self.juju, self.unit, script.CODECS["zstd"].at_level(12))
+
+        self.assertEqual("pigz", codec.name)
+        self.assertEqual(9, codec.level)
+
+    def test_probe_failure(self):
+        """If the unit can't be checked, gzip is used."""
+        self.check_output.side_effect = subprocess.CalledProcessError(
+            1, "ssh", b"oops")
+
+        codec = script.choose_unit_codec(
+            self.juju, self.unit, script.CODECS["zstd"])
+
+        self.assertEqual("gzip", codec.name)
+
+    def test_missing_locally(self):
+        """zstd isn't used if it can't be decompressed locally."""
+        script._which.return_value = False
+        self.check_output.return_value = b"/usr/bin/zstd\n/usr/bin/pigz\n"
+
+        codec = script.choose_unit_codec(
+            self.juju, self.unit, script.CODECS["zstd"])
+
+        self.assertEqual("pigz", codec.name)
+
+
 class GetJujuTests(TestWithFixtures):
 
     def test_juju1_outer(self):
@@ -265,15 +1044,100 @@ class GetJujuTests(TestWithFixtures):
         self.assertEqual(juju, expected)
 
 
+class SSHMultiplexingTests(TestWithFixtures):
+
+    def setUp(self):
+        super(SSHMultiplexingTests, self).setUp()
+        self.useFixture(
+            EnvironmentVariableFixture("JUJU_DATA", "some-dir"))
+        self.juju = script.get_juju(script.JUJU2, juju_ssh=False)
+        self.juju.start_multiplexing()
+        self.addCleanup(shutil.rmtree, self.juju.control_dir, True)
+        self.control_path = os.path.join(self.juju.control_dir, "ubuntu-0")
+        self.mux_args = [
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath={}".format(self.control_path),
+            "-o", "ControlPersist=10m"]
+
+    def test_ssh_args(self):
+        """Direct ssh commands share the unit's master connection."""
+        unit = script.JujuUnit("ubuntu/0", "10.1.1.1")
+        expected = [
+            "/usr/bin/ssh", "-o", "StrictHostKeyChecking=no",
+            "-i", "some-dir/ssh/juju_id_rsa"] + self.mux_args + [
+            "ubuntu@10.1.1.1", "ls tmp"]
+        self.assertEqual(expected, self.juju.ssh_args(unit, "ls tmp"))
+
+    def test_models(self):
+        """
+        Units of different models don't share connections, even when named
+        alike.
+        """
+        juju = self.juju.for_model("other")
+        unit = script.JujuUnit("ubuntu/0", "10.1.1.2", "other")
+
+        args = juju.ssh_args(unit, "ls tmp")
+
+        self.assertIn("ControlPath={}".format(
+            os.path.join(self.juju.control_dir, "other-ubuntu-0")), args)
+        self.assertEqual("other", juju.model)
+        self.assertIsNone(self.juju.model)
+
+    def test_pull_and_push_args(self):
+        """Direct scp commands share the unit's master connection."""
+        unit = script.JujuUnit("ubuntu/0", "10.1.1.1")
+        scp = ["/usr/bin/scp", "-o", "StrictHostKeyChecking=no",
+               "-i", "some-dir/ssh/juju_id_rsa"] + self.mux_args
+        self.assertEqual(scp + ["ubuntu@10.1.1.1:file1", "."],
+                         self.juju.pull_args(unit, "file1"))
+        self.assertEqual(scp + ["file1", "ubuntu@10.1.1.1:/tmp/blah"],
+                         self.juju.push_args(unit, "file1", "/tmp/blah"))
+
+    def test_juju_ssh_args(self):
+        """juju ssh is handed the ssh options after the target."""
+        unit = script.JujuUnit("ubuntu/0", script.NO_PUBLIC_ADDRESS)
+        expected = ["juju-2.1", "ssh", "ubuntu/0"] + self.mux_args + [
+            "ls tmp"]
+        self.assertEqual(expected, self.juju.ssh_args(unit, "ls tmp"))
+
+    def test_juju_scp_args(self):
+        """juju scp is handed the ssh options after "--"."""
+        unit = script.JujuUnit("ubuntu/0", script.NO_PUBLIC_ADDRESS)
+        expected = ["juju-2.1", "scp", "--"] + self.mux_args + [
+            "ubuntu/0:file1", "."]
+        self.assertEqual(expected, self.juju.pull_args(unit, "file1"))
+
+    def test_stop_multiplexing(self):
+        """
+        stop_multiplexing() asks every master connection to exit and
+        removes the control sockets.
+        """
+        control_dir = self.juju.control_dir
+        _create_file(self.control_path)
+        with mock.patch.object(script, "check_output") as check_output:
+            self.juju.stop_multiplexing()
+
+        check_output.assert_called_once_with(
+            ["/usr/bin/ssh", "-o", "ControlPath={}".format(self.control_path),
+             "-O", "exit", "ubuntu-0"], stderr=subprocess.STDOUT)
+        self.assertFalse(os.path.exists(control_dir))
+        self.assertIsNone(self.juju.control_dir)
+        unit = script.JujuUnit("ubuntu/0", script.NO_PUBLIC_ADDRESS)
+        self.assertEqual(["juju-2.1", "ssh", "ubuntu/0", "ls tmp"],
+                         self.juju.ssh_args(unit, "ls tmp"))
+
+
 class MainTestCase(_BaseTestCase):
 
-    MOCKED = ("collect_logs", "collect_inner_logs", "bundle_logs")
+    MOCKED = ("get_status", "collect_logs", "bundle_logs", "BundleWriter")
 
     def setUp(self):
         super(MainTestCase, self).setUp()
 
         self.orig_mkdtemp = script.mkdtemp
         script.mkdtemp = lambda: self.tempdir
+        self.status = script.get_status.return_value
+        self.bundle = script.BundleWriter.return_value
 
     def tearDown(self):
         script.mkdtemp = self.orig_mkdtemp
@@ -282,28 +1146,126 @@ class MainTestCase(_BaseTestCase):
 
     def test_success(self):
         """
-        main() calls collect_logs(), collect_inner_logs(), and bundle_logs().
+        main() calls collect_logs(), with the inner model, and bundle_logs().
         """
         tarfile = "/tmp/logs.tgz"
         extrafiles = ["spam.py"]
 
         script.main(tarfile, extrafiles, juju=self.juju)
 
-        script.collect_logs.assert_called_once_with(self.juju)
-        script.collect_inner_logs.assert_called_once_with(
-            self.juju, script.DEFAULT_MODEL)
+        script.BundleWriter.assert_called_once_with(
+            tarfile, mock.ANY, dedup=False)
+        script.collect_logs.assert_called_once_with(
+            self.juju, self.status, mock.ANY, self.bundle,
+            script.DEFAULT_MODEL)
         script.bundle_logs.assert_called_once_with(
-            self.tempdir, tarfile, extrafiles)
+            self.tempdir, self.bundle, extrafiles)
+        self.bundle.abort.assert_not_called()
         self.assertFalse(os.path.exists(self.tempdir))
 
+    def test_stdout(self):
+        """
+        main() writes a .tar.gz bundle to stdout if the tarfile is "-",
+        whatever the codec.
+        """
+        options = script.CollectOptions(compress="zstd")
+
+        with mock.patch.object(script, "claim_stdout") as claim_stdout:
+            script.main("-", [], juju=self.juju, options=options)
+
+        out = claim_stdout.return_value
+        script.BundleWriter.assert_called_once_with(
+            "-", mock.ANY, dedup=False, fileobj=out)
+        codec = script.BundleWriter.call_args[0][1]
+        self.assertEqual(".gz", codec.extension)
+        out.close.assert_called_once_with()
+
+    def test_models(self):
+        """
+        main() collects several models at once, each with its status saved
+        in its own directory.
+        """
+        self.status.filename = "juju-status.yaml"
+        saved = []
+        self.status.save.side_effect = (
+            lambda filename: saved.append(os.path.exists(
+                os.path.dirname(filename))) or mock.DEFAULT)
+
+        with mock.patch.object(script, "collect_models") as collect_models:
+            script.main("/tmp/logs.tgz", [], juju=self.juju,
+                        models=["admin/default", "monitoring"])
+
+        self.assertEqual(
+            ["admin/default", "monitoring"],
+            [call[0][0].model for call in script.get_status.call_args_list])
+        self.status.save.assert_has_calls([
+            mock.call(os.path.join(
+                self.tempdir, "admin-default", "juju-status.yaml")),
+            mock.call(os.path.join(
+                self.tempdir, "monitoring", "juju-status.yaml"))])
+        self.assertEqual([True, True], saved)
+        models = collect_models.call_args[0][0]
+        self.assertEqual(
+            [("admin/default", self.status, "admin-default"),
+             ("monitoring", self.status, "monitoring")],
+            [(juju.model, status, dirname)
+             for juju, status, dirname in models])
+        self.assertEqual(
+            (mock.ANY, self.bundle, script.DEFAULT_MODEL),
+            collect_models.call_args[0][1:])
+        script.collect_logs.assert_not_called()
+
+    def test_status_saved_in_bundle(self):
+        """
+        main() saves the status snapshot into the bundle directory.
+        """
+        self.status.filename = "juju-status.yaml"
+
+        script.main("/tmp/logs.tgz", [], juju=self.juju)
+
+        script.get_status.assert_called_once_with(self.juju)
+        self.status.save.assert_called_once_with(
+            os.path.join(self.tempdir, "juju-status.yaml"))
+
+    def test_options(self):
+        """
+        main() hands its options to collect_logs().
+        """
+        options = script.CollectOptions(jobs=3)
+
+        script.main("/tmp/logs.tgz", [], juju=self.juju, options=options)
+
+        script.collect_logs.assert_called_once_with(
+            self.juju, self.status, options, self.bundle,
+            script.DEFAULT_MODEL)
+        script.collect_logs.return_value.save.assert_called_once_with(
+            os.path.join(self.tempdir, script.STATS_FILENAME))
+
+    def test_low_impact(self):
+        """
+        main() has the ssh and scp commands keep to the options' impact.
+        """
+        options = script.CollectOptions(low_impact=True, unit_rate=1000)
+
+        script.main("/tmp/logs.tgz", [], juju=self.juju, options=options)
+
+        self.assertTrue(self.juju.low_priority)
+        self.assertEqual(1000, self.juju.transfer_rate)
+
+    def test_total_rate_scp(self):
+        """scp doesn't go past the total rate, even without a unit rate."""
+        options = script.CollectOptions(total_rate=4000)
+
+        script.main("/tmp/logs.tgz", [], juju=self.juju, options=options)
+
+        self.assertEqual(4000, self.juju.transfer_rate)
+
     def test_in_correct_directories(self):
         """
         main() calls its dependencies while in specific directories.
         """
         script.collect_logs.side_effect = (
-            lambda _: self.assert_cwd(self.tempdir))
-        script.collect_inner_logs.side_effect = (
-            lambda _: self.assert_cwd(self.tempdir))
+            lambda *a: self.assert_cwd(self.tempdir) or mock.DEFAULT)
         script.bundle_logs.side_effect = lambda *a: self.assert_cwd(self.cwd)
         tarfile = "/tmp/logs.tgz"
         extrafiles = ["spam.py"]
@@ -312,7 +1274,7 @@ class MainTestCase(_BaseTestCase):
 
     def test_no_script_recursion_for_inner_model(self):
         """
-        main() will not call collect_inner_logs() if --inner is True.
+        main() doesn't collect an inner model if --inner is True.
         """
         tarfile = "/tmp/logs.tgz"
         extrafiles = ["spam.py"]
@@ -321,10 +1283,10 @@ class MainTestCase(_BaseTestCase):
 
         script.main(tarfile, extrafiles, juju=juju, inner=True)
 
-        script.collect_logs.assert_called_once_with(juju)
-        script.collect_inner_logs.assert_not_called()
+        script.collect_logs.assert_called_once_with(
+            juju, self.status, mock.ANY, self.bundle, None)
         script.bundle_logs.assert_called_once_with(
-            self.tempdir, tarfile, extrafiles)
+            self.tempdir, self.bundle, extrafiles)
         self.assertFalse(os.path.exists(self.tempdir))
 
     def test_cleanup(self):
@@ -338,41 +1300,37 @@ class MainTestCase(_BaseTestCase):
 
         self.assertFalse(os.path.exists(self.tempdir))
 
-    def test_collect_logs_error(self):
+    def test_closes_ssh_connections(self):
         """
-        main() doesn't handle the error when collect_logs() fails.
-
-        It still cleans up the temp dir.
+        main() closes the shared ssh connections, even when collecting
+        fails.
         """
-        tarfile = "/tmp/logs.tgz"
-        extrafiles = ["spam.py"]
         script.collect_logs.side_effect = FakeError()
 
-        with self.assertRaises(FakeError):
-            script.main(tarfile, extrafiles, juju=self.juju)
+        with mock.patch.object(self.juju, "stop_multiplexing") as stop:
+            with self.assertRaises(FakeError):
+                script.main("/tmp/logs.tgz", [], juju=self.juju)
 
-        script.collect_logs.assert_called_once_with(self.juju)
-        script.collect_inner_logs.assert_not_called()
-        script.bundle_logs.assert_not_called()
-        self.assertFalse(os.path.exists(self.tempdir))
+        stop.assert_called_once_with()
 
-    def test_collect_inner_logs_error(self):
+    def test_collect_logs_error(self):
         """
-        main() ignores the error when collect_inner_logs() fails.
+        main() doesn't handle the error when collect_logs() fails.
 
         It still cleans up the temp dir.
         """
         tarfile = "/tmp/logs.tgz"
         extrafiles = ["spam.py"]
-        script.collect_inner_logs.side_effect = FakeError()
+        script.collect_logs.side_effect = FakeError()
 
-        script.main(tarfile, extrafiles, juju=self.juju)
+        with self.assertRaises(FakeError):
+            script.main(tarfile, extrafiles, juju=self.juju)
 
-        script.collect_logs.assert_called_once_with(self.juju)
-        script.collect_inner_logs.assert_called_once_with(
-            self.juju, script.DEFAULT_MODEL)
-        script.bundle_logs.assert_called_once_with(
-            self.tempdir, tarfile, extrafiles)
+        script.collect_logs.assert_called_once_with(
+            self.juju, self.status, mock.ANY, self.bundle,
+            script.DEFAULT_MODEL)
+        script.bundle_logs.assert_not_called()
+        self.bundle.abort.assert_called_once_with()
         self.assertFalse(os.path.exists(self.tempdir))
 
     def test_bundle_logs_error(self):
@@ -388,17 +1346,17 @@ class MainTestCase(_BaseTestCase):
         with self.assertRaises(FakeError):
             script.main(tarfile, extrafiles, juju=self.juju)
 
-        script.collect_logs.assert_called_once_with(self.juju)
-        script.collect_inner_logs.assert_called_once_with(
-            self.juju, script.DEFAULT_MODEL)
+        script.collect_logs.assert_called_once_with(
+            self.juju, self.status, mock.ANY, self.bundle,
+            script.DEFAULT_MODEL)
         script.bundle_logs.assert_called_once_with(
-            self.tempdir, tarfile, extrafiles)
+            self.tempdir, self.bundle, extrafiles)
         self.assertFalse(os.path.exists(self.tempdir))
 
 
 class CreateOutputFilesTestCase(_BaseTestCase):
 
-    MOCKED = ("call", "check_output", "get_units", "get_hosts", "mkdtemp")
+    MOCKED = ("call", "check_output", "get_units", "get_hosts")
 
     def setUp(self):
         super(CreateOutputFilesTestCase, self).setUp()
@@ -406,83 +1364,198 @@ class CreateOutputFilesTestCase(_BaseTestCase):
             script.JujuHost("0", "1.2.3.8"),
         ]
         script.get_hosts.return_value = self.hosts[:]
-        self.tmpdir = tempfile.mkdtemp()
-        script.mkdtemp.return_value = self.tmpdir
+        script.call.return_value = 0
+        patcher = mock.patch.object(
+            script, "_upload_path", side_effect=lambda name: "/tmp/up-" + name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.helper = script.remote_helper()
+        with open(script.PRG, "rb") as f:
+            self.digest = hashlib.sha1(f.read()).hexdigest()
+        self.install = [
+            mock.call(["juju", "scp", script.PRG, "0:/tmp/up-helper"],
+                      env=None),
+            mock.call(["juju", "ssh", "0", script._format_install_command(
+                "/tmp/up-helper", self.helper, self.digest)], env=None)]
+        self.command = (
+            "test -f {0} || exit 100; "
+            "python=$(command -v python3 || command -v python) || exit 101; "
+            "sudo $python {0} --ps-mem /var/log/ps_mem.txt").format(
+                self.helper)
 
-    def tearDown(self):
-        if os.path.exists(self.tmpdir):
-            # self.tmpdir is returned by the mocked tempfile.mkdtemp()
-            # Normally, this won't exist as collect-logs should remove it.
-            shutil.rmtree(self.tmpdir)
-        super(CreateOutputFilesTestCase, self).tearDown()
+    def test_remote_helper(self):
+        """
+        The helper is named after the digest of collect-logs, where only
+        root can write.
+        """
+        self.assertEqual(
+            "/var/lib/collect-logs/collect-logs-" + self.digest[:12],
+            self.helper)
 
-    def test_get_ps_mem_with_git_clone(self):
+    def test_upload_helper(self):
         """
-        Clone the ps_mem repo when there is no local copy.
+        collect-logs itself is copied to the unit, and installed from there
+        as the helper.
         """
-        ps_mem_file = os.path.join(self.tmpdir, "ps_mem.py")
-        repo_path = os.path.join(self.tmpdir, "ps_mem")
-        script._get_ps_mem(ps_mem_file, script.PS_MEM_REPO, repo_path)
-        expected = [
-            mock.call(["git", "clone", script.PS_MEM_REPO, repo_path],
-            stderr=subprocess.STDOUT),
-        ]
-        self.assertEqual(expected, script.check_output.call_args_list)
+        self.assertTrue(script.upload_helper(self.juju, self.hosts[0]))
+        self.assertEqual(self.install, script.call.call_args_list)
 
-    def test_get_ps_mem_local(self):
+    def test_install_command(self):
         """
-        Don't clone the ps_mem repo when there is a local copy.
+        The installed helper is removed again if it isn't collect-logs,
+        and what was copied is removed either way.
         """
-        ps_mem_file = os.path.join(self.tmpdir, "ps_mem.py")
-        with open(ps_mem_file, 'w') as outfile:
-            outfile.write("# This is a fake ps_mem.py")
-        repo_path = os.path.join(self.tmpdir, "ps_mem")
-        result = script._get_ps_mem(ps_mem_file, script.PS_MEM_REPO, repo_path)
-        self.assertEqual(ps_mem_file, result)
-        script.check_output.assert_not_called()
+        bindir = os.path.join(self.tempdir, "bin")
+        os.mkdir(bindir)
+        # Fake sudo and install, without the change of owner.
+        _create_file(os.path.join(bindir, "sudo"), '#!/bin/sh\nexec "$@"\n')
+        _create_file(os.path.join(bindir, "install"),
+                     '#!/bin/sh\nmkdir -p "$(dirname "$9")" && '
+                     'cp "$8" "$9"\n')
+        for name in ("sudo", "install"):
+            os.chmod(os.path.join(bindir, name), 0o755)
+        env = dict(os.environ, PATH=bindir + ":" + os.environ["PATH"])
+        source = os.path.join(self.tempdir, "upload")
+        target = os.path.join(self.tempdir, "lib", "helper")
+        for data, returncode in (("collect-logs", 0), ("planted", 1)):
+            _create_file(source, data)
+            command = script._format_install_command(
+                source, target, hashlib.sha1(b"collect-logs").hexdigest())
 
-    def test_upload_ps_mem(self):
+            self.assertEqual(returncode, subprocess.call(
+                ["sh", "-c", command], env=env))
+
+            self.assertEqual(not returncode, os.path.exists(target))
+            self.assertFalse(os.path.exists(source))
+
+    def test_upload_helper_failure(self):
         """
-        Verify that the repo is cloned and file uploaded.
+        upload_helper() returns False if the copy fails.
         """
-        script.upload_ps_mem(self.juju, self.hosts[0])
-        repo_path = os.path.join(self.tmpdir, "ps_mem")
-        expected = [
-            mock.call(["git", "clone", script.PS_MEM_REPO, repo_path],
-            stderr=subprocess.STDOUT),
-        ]
-        self.assertEqual(expected, script.check_output.call_args_list)
-        source = os.path.join(repo_path, "ps_mem.py")
-        target = "{}:/tmp/ps_mem.py".format(self.hosts[0].name)
-        expected = [
-            mock.call(["juju", "scp", source, target],
-                      env=None),
-        ]
-        self.assertEqual(expected, script.call.call_args_list)
+        script.call.return_value = 1
+        self.assertFalse(script.upload_helper(self.juju, self.hosts[0]))
 
     def test_create_ps_mem_output_file(self):
         """
-        Verify expected commands when creating the ps_mem output.
+        The memory footprint is written by the helper the unit already
+        has, without installing anything.
         """
         script._create_ps_mem_output_file(self.juju, self.hosts[0])
-        repo_path = os.path.join(self.tmpdir, "ps_mem")
         expected = [
-            mock.call([
-                "juju", "ssh", "0",
-                "if ! python -V; then sudo apt-get install -y python; fi"],
-            env=None, stderr=subprocess.STDOUT),
-            mock.call([
-                "juju", "ssh", "0",
-                "sudo /tmp/ps_mem.py -S | sudo tee /var/log/ps_mem.txt"],
-            env=None, stderr=subprocess.STDOUT),
+            mock.call(["juju", "ssh", "0", self.command],
+                      env=None, stderr=subprocess.STDOUT),
         ]
         self.assertEqual(expected, script.check_output.call_args_list)
+        script.call.assert_not_called()
+
+    def test_create_ps_mem_output_file_uploads(self):
+        """
+        The helper is copied to units that don't have it, and run again.
+        """
+        script.check_output.side_effect = [
+            subprocess.CalledProcessError(script.HELPER_MISSING, "ssh"), b""]
+        script._create_ps_mem_output_file(self.juju, self.hosts[0])
+        call = mock.call(["juju", "ssh", "0", self.command],
+                         env=None, stderr=subprocess.STDOUT)
+        self.assertEqual([call, call], script.check_output.call_args_list)
+        self.assertEqual(self.install, script.call.call_args_list)
+
+    def test_create_ps_mem_output_file_failure(self):
+        """
+        Failing to collect the memory footprint isn't fatal, and the
+        helper is only copied when it's missing.
+        """
+        script.check_output.side_effect = (
+            subprocess.CalledProcessError(1, "ssh"))
+        script._create_ps_mem_output_file(self.juju, self.hosts[0])
+        self.assertEqual(1, script.check_output.call_count)
+        script.call.assert_not_called()
+
+
+class UploadPathTests(TestCase):
+
+    def test_unguessable(self):
+        """Files are copied to the units' /tmp under unguessable names."""
+        path = script._upload_path("helper")
+        self.assertTrue(path.startswith("/tmp/collect-logs-"))
+        self.assertTrue(path.endswith("-helper"))
+        self.assertNotEqual(path, script._upload_path("helper"))
+
+
+class PsMemTests(TestCase):
+
+    def setUp(self):
+        super(PsMemTests, self).setUp()
+        self.proc = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.proc)
+
+    def add_process(self, pid, cmdline, exe=None, comm=None, smaps=None,
+                    statm=None):
+        dirname = os.path.join(self.proc, str(pid))
+        _create_file(os.path.join(dirname, "cmdline"), cmdline)
+        if exe is not None:
+            os.symlink(exe, os.path.join(dirname, "exe"))
+        if comm is not None:
+            _create_file(os.path.join(dirname, "comm"), comm + "\n")
+        if smaps is not None:
+            _create_file(os.path.join(dirname, "smaps_rollup"), "".join(
+                "{}: {} kB\n".format(key, value)
+                for key, value in sorted(smaps.items())))
+        if statm is not None:
+            _create_file(os.path.join(dirname, "statm"), statm)
+
+    def test_ps_mem_report(self):
+        """
+        Processes are summed up by program, from the smallest to the
+        largest, and kernel threads are left out.
+        """
+        smaps = {"Rss": 3000, "Pss": 2048, "Private_Clean": 24,
+                 "Private_Dirty": 1000, "Swap": 10}
+        self.add_process(1, "/usr/bin/apache2\0-k\0start\0",
+                         exe="/usr/sbin/apache2", smaps=smaps)
+        self.add_process(2, "/usr/bin/apache2\0-k\0start\0",
+                         exe="/usr/sbin/apache2 (deleted)", smaps=smaps)
+        self.add_process(3, "", comm="kthreadd")
+        self.add_process(4, "cron\0", comm="cron",
+                         smaps={"Pss": 100, "Private_Dirty": 60,
+                                "SwapPss": 1, "Swap": 100})
+        _create_file(os.path.join(self.proc, "meminfo"), "")
+
+        self.assertEqual(
+            " Private  +   Shared  =  RAM used   Swap used\tProgram\n"
+            "\n"
+            " 60.0 KiB +  40.0 KiB = 100.0 KiB     1.0 KiB\tcron\n"
+            "  2.0 MiB +   2.0 MiB =   4.0 MiB    20.0 KiB\tapache2 (2)\n"
+            "---------------------------------------------\n"
+            "                          4.1 MiB    21.0 KiB\n"
+            "=============================================\n",
+            script.ps_mem_report(self.proc))
+
+    def test_ps_mem_report_without_smaps(self):
+        """
+        Without smaps, the memory used is taken from statm.
+        """
+        self.add_process(1, "init\0", comm="init", statm="10 5 2 1 0 3 0\n")
+        page = os.sysconf("SC_PAGE_SIZE") // 1024
+        self.assertEqual(
+            (3 * page, 2 * page, 0), script._proc_memory(self.proc, "1"))
+
+    def test_ps_mem_main(self):
+        """
+        collect-logs --ps-mem writes the report to the file given.
+        """
+        output = os.path.join(self.proc, "ps_mem.txt")
+        with mock.patch.object(script, "ps_mem_report",
+                               return_value="report\n"):
+            self.assertEqual(0, script.ps_mem_main([output]))
+        with open(output) as f:
+            self.assertEqual("report\n", f.read())
 
 
 class CollectLogsTestCase(_BaseTestCase):
 
     MOCKED = ("get_units", "get_bootstrap_ip", "check_output", "call",
-              "get_hosts", "upload_ps_mem", "_create_ps_mem_output_file")
+              "get_hosts", "_create_ps_mem_output_file")
 
     def setUp(self):
         super(CollectLogsTestCase, self).setUp()
@@ -499,17 +1572,12 @@ class CollectLogsTestCase(_BaseTestCase):
             script.JujuHost("0", "1.2.3.8"),
         ]
         script.get_hosts.return_value = self.hosts[:]
-
-        self.mp_map_orig = script._mp_map
-        script._mp_map = lambda f, a: map(f, a)
+        self.status = script.JujuStatus(self.juju, {})
+        # A single job makes the order of the mocked calls predictable.
+        self.options = script.CollectOptions(jobs=1)
 
         os.chdir(self.tempdir)
 
-    def tearDown(self):
-        script._mp_map = self.mp_map_orig
-
-        super(CollectLogsTestCase, self).tearDown()
-
     def _call_side_effect(self, cmd, env=None):
         """Perform the side effect of calling the mocked-out call()."""
         if cmd[0] == "tar":
@@ -517,7 +1585,9 @@ class CollectLogsTestCase(_BaseTestCase):
             return
         self.assertEqual(env, self.juju.env)
         self.assertEqual(cmd[0], self.juju.binary_path)
-        _create_file(os.path.basename(cmd[2]))
+        if cmd[1] == "scp":
+            _create_file(os.path.basename(cmd[-2]))
+        return 0
 
     def test_success(self):
         """
@@ -525,9 +1595,9 @@ class CollectLogsTestCase(_BaseTestCase):
         """
         script.call.side_effect = self._call_side_effect
 
-        script.collect_logs(self.juju)
+        script.collect_logs(self.juju, self.status, self.options)
 
-        script.get_units.assert_called_once_with(self.juju)
+        script.get_units.assert_called_once_with(self.juju, self.status)
         expected = []
         units = self.units + [script.JujuUnit("0", "1.2.3.3")]
         # for _create_ps_output_file()
@@ -537,6 +1607,17 @@ class CollectLogsTestCase(_BaseTestCase):
                                       stderr=subprocess.STDOUT,
                                       env=None,
                                       ))
+        # for _create_manifest_file()
+        for unit in units:
+            cmd = ("sudo find $(sudo sh -c \"ls -1d {} 2>/dev/null\")"
+                   " ! -type d ! -path /var/log/collect-logs-manifest.txt"
+                   " -printf '%i %s %T@ %p\\n' 2>/dev/null"
+                   " | sudo tee /var/log/collect-logs-manifest.txt > /dev/null"
+                   ).format(" ".join(script.LOGS))
+            expected.append(mock.call(["juju", "ssh", unit.name, cmd],
+                                      stderr=subprocess.STDOUT,
+                                      env=None,
+                                      ))
         # for _create_log_tarball()
         for unit in units:
             tarfile = "/tmp/logs_{}.tar".format(unit.name.replace("/", "-")
@@ -591,6 +1672,9 @@ class CollectLogsTestCase(_BaseTestCase):
             source = "{}:/tmp/{}".format(unit.name, filename)
             expected.append(mock.call(["juju", "scp", source, "."], env=None))
             expected.append(mock.call(["tar", "-C", name, "-xzf", filename]))
+            expected.append(mock.call(
+                ["juju", "ssh", unit.name, "sudo rm -f /tmp/" + filename],
+                env=None))
             self.assertFalse(os.path.exists(filename))
         self.assertEqual(script.call.call_count, len(expected))
         script.call.assert_has_calls(expected, any_order=True)
@@ -605,9 +1689,9 @@ class CollectLogsTestCase(_BaseTestCase):
         self.juju = juju
         script.call.side_effect = self._call_side_effect
 
-        script.collect_logs(juju)
+        script.collect_logs(juju, self.status, self.options)
 
-        script.get_units.assert_called_once_with(juju)
+        script.get_units.assert_called_once_with(juju, self.status)
         expected = []
         units = self.units + [script.JujuUnit("0", "1.2.3.3")]
         # for _create_ps_output_file()
@@ -618,6 +1702,14 @@ class CollectLogsTestCase(_BaseTestCase):
                                       stderr=subprocess.STDOUT,
                                       env=juju.env,
                                       ))
+        # for _create_manifest_file()
+        for unit in units:
+            cmd = script._format_manifest_command()
+            expected.append(mock.call(["juju-2.1", "ssh",
+                                       "-m", "controller", unit.name, cmd],
+                                      stderr=subprocess.STDOUT,
+                                      env=juju.env,
+                                      ))
         # for _create_log_tarball()
         for unit in units:
             tarfile = "/tmp/logs_{}.tar".format(unit.name.replace("/", "-")
@@ -676,72 +1768,330 @@ class CollectLogsTestCase(_BaseTestCase):
                 ["juju-2.1", "scp", "-m", "controller", source, "."],
                 env=juju.env))
             expected.append(mock.call(["tar", "-C", name, "-xzf", filename]))
+            expected.append(mock.call(
+                ["juju-2.1", "ssh", "-m", "controller", unit.name,
+                 "sudo rm -f /tmp/" + filename],
+                env=juju.env))
             self.assertFalse(os.path.exists(filename))
         self.assertEqual(script.call.call_count, len(expected))
         script.call.assert_has_calls(expected, any_order=True)
 
-    def test_get_units_failure(self):
+    def test_download_into_bundle(self):
         """
-        collect_logs() does not handle errors from get_units().
+        With a bundle, each downloaded tarball is added to it under the
+        unit's directory instead of being extracted.
         """
-        script.get_units.side_effect = FakeError()
+        def call_side_effect(cmd, env=None):
+            if cmd[1] == "scp":
+                filename = os.path.basename(cmd[-2])
+                with open(filename, "wb") as f:
+                    f.write(_make_archive({"var/log/syslog": b"log"}).read())
+            return 0
+        script.call.side_effect = call_side_effect
+        tarfile_path = os.path.join(self.cwd, "logs.tgz")
+        bundle = script.BundleWriter(tarfile_path)
 
-        with self.assertRaises(FakeError):
-            script.collect_logs(self.juju)
+        script.collect_logs(self.juju, self.status, self.options, bundle)
+        bundle.close()
 
-        script.get_units.assert_called_once_with(self.juju)
-        script.check_output.assert_not_called()
-        script.call.assert_not_called()
+        self.assertEqual([], os.listdir(self.tempdir))
+        expected = [
+            "{}/var/log/syslog".format(name) for name in
+            ["landscape-server-0", "postgresql-0", "rabbitmq-server-0",
+             "haproxy-0", "bootstrap"]]
+        self.assertEqual(sorted(expected), _bundle_names(tarfile_path))
+        self.assertNotIn(
+            "tar", [args[0][0] for args, _ in script.call.call_args_list])
 
-    def test_get_hosts_failure(self):
+    def test_deadline_passed(self):
         """
-        collect_logs() does not handle errors from get_hosts().
+        Units aren't collected once the deadline has passed, and the summary
+        says so.
         """
-        script.get_hosts.side_effect = FakeError()
+        options = script.CollectOptions(jobs=1, deadline=time.time() - 1)
 
-        with self.assertRaises(FakeError):
-            script.collect_logs(self.juju)
+        summary = script.collect_logs(self.juju, self.status, options)
 
-        script.get_hosts.assert_called_once_with(self.juju)
-        self.assertEqual(script.check_output.call_count, 5)
+        script.check_output.assert_not_called()
         script.call.assert_not_called()
+        self.assertEqual(
+            ["0", "haproxy/0", "landscape-server/0", "postgresql/0",
+             "rabbitmq-server/0"],
+            summary.unfinished())
+        self.assertEqual(
+            set(["skipped"]),
+            set(unit["state"] for unit in summary.units.values()))
+
+    def test_stats(self):
+        """Each unit's phases are timed."""
+        script.call.side_effect = self._call_side_effect
 
-    def test_check_output_failure(self):
+        stats = script.collect_logs(self.juju, self.status, self.options)
+
+        self.assertEqual(
+            ["codec", "compress", "extract", "manifest", "ps", "tar",
+             "transfer"],
+            sorted(stats.units["haproxy/0"]["phases"]))
+        self.assertIn("collect", stats.phases)
+
+    def test_inner_model(self):
         """
-        collect_logs() does not handle errors from check_output().
+        The inner model is collected first, alongside the units, with the
+        same status and options.
         """
-        script.check_output.side_effect = [mock.DEFAULT,
-                                           FakeError(),
-                                           ]
+        steps = []
+        script.call.side_effect = self._call_side_effect
+        script.check_output.side_effect = (
+            lambda args, **kw: steps.append(args[2]))
+
+        with mock.patch.object(script, "collect_inner_logs") as inner:
+            inner.side_effect = lambda *args: steps.append("inner")
+            stats = script.collect_logs(
+                self.juju, self.status, self.options, None,
+                script.DEFAULT_MODEL)
+
+        inner.assert_called_once_with(
+            self.juju, script.DEFAULT_MODEL, self.status, self.options, None,
+            "landscape-0-inner-logs")
+        self.assertEqual("inner", steps[0])
+        self.assertIn("inner", stats.phases)
+        self.assertEqual([], stats.unfinished())
+
+    def test_inner_model_error(self):
+        """
+        Failing to collect the inner model is logged, and doesn't stop the
+        units from being collected.
+        """
+        script.call.side_effect = self._call_side_effect
+
+        with mock.patch.object(script, "collect_inner_logs") as inner:
+            inner.side_effect = FakeError()
+            with mock.patch.object(script.log, "warning") as warning:
+                stats = script.collect_logs(
+                    self.juju, self.status, self.options, None,
+                    script.DEFAULT_MODEL)
+
+        warning.assert_any_call("Collecting inner logs failed, continuing")
+        self.assertEqual([], stats.unfinished())
+        self.assertTrue(os.path.isdir("haproxy-0"))
+
+    def test_models(self):
+        """
+        collect_models() collects the units of several models, each under
+        its model's directory.  Machines shared by the models, like the
+        bootstrap one, are only collected for the first.
+        """
+        other_units = [script.JujuUnit("mysql/0", "1.2.4.1"),
+                       script.JujuUnit("nagios/0", self.units[3].ip)]
+        script.get_units.side_effect = lambda juju, status: {
+            "default": self.units, "other": other_units}[juju.model][:]
+        script.get_hosts.side_effect = lambda juju, status: {
+            "default": self.hosts,
+            "other": [script.JujuHost("0", "1.2.3.8"),
+                      script.JujuHost("1", "1.2.4.1")]}[juju.model][:]
+        script.call.side_effect = self._call_side_effect
+        status = script.JujuStatus(self.juju, {"machines": {"0": {}}})
+
+        stats = script.collect_models(
+            [(self.juju.for_model("default"), status, "default"),
+             (self.juju.for_model("other"), status, "other")],
+            self.options)
+
+        self.assertEqual(
+            ["bootstrap", "haproxy-0", "landscape-server-0", "postgresql-0",
+             "rabbitmq-server-0"],
+            sorted(os.listdir("default")))
+        self.assertEqual(["mysql-0"], os.listdir("other"))
+        self.assertEqual(
+            ["default/0", "default/haproxy/0", "default/landscape-server/0",
+             "default/postgresql/0", "default/rabbitmq-server/0",
+             "other/machine-1", "other/mysql/0"],
+            sorted(stats.units))
+        script.check_output.assert_any_call(
+            ["juju", "ssh", "-e", "other", "mysql/0",
+             "ps fauxww | sudo tee /var/log/ps-fauxww.txt"],
+            stderr=subprocess.STDOUT, env=None)
+
+    def test_model_without_units(self):
+        """A model without units only contributes its machines."""
+        script.get_units.side_effect = SystemExit("no units")
+        status = script.JujuStatus(self.juju, {"machines": {}})
+
+        stats = script.collect_models(
+            [(self.juju.for_model("controller"), status, "controller")],
+            self.options)
+
+        self.assertEqual(["controller/machine-0"], sorted(stats.units))
+
+    def test_largest_first(self):
+        """
+        The units expected to bring in the most, those on a whole machine
+        and with subordinates, are collected first.  Units on the same
+        physical machine, or through the juju ssh proxy, are limited.
+        """
+        units = dict((unit.name, {"machine": machine}) for unit, machine in
+                     zip(self.units, ["1/lxd/0", "2", "1/lxd/1", "3"]))
+        units["postgresql/0"]["subordinates"] = {"telegraf/0": {}}
+        raw = {"applications": dict(
+            (name.split("/")[0], {"units": {name: unit}})
+            for name, unit in units.items())}
+        status = script.JujuStatus(self.juju, raw)
+        script.get_hosts.return_value = []
+        options = script.CollectOptions(jobs=1, machine_jobs=3)
+
+        with mock.patch.object(script, "collect_unit") as collect_unit, \
+                mock.patch.object(script, "Engine",
+                                  wraps=script.Engine) as engine:
+            script.collect_logs(self.juju, status, options)
+
+        self.assertEqual(
+            ["postgresql/0", "haproxy/0", "0", "landscape-server/0",
+             "rabbitmq-server/0"],
+            [args[1].name for args, _ in collect_unit.call_args_list])
+        engine.assert_called_once_with(
+            1, {"machine": 3, "proxy": script.DEFAULT_PROXY_JOBS})
+
+    def test_estimate_payload(self):
+        """
+        A unit's baseline manifest gives its payload; otherwise it's
+        guessed at from the status.
+        """
+        unit = script.JujuUnit("haproxy/0", "1.2.3.7")
+        baseline = "1 100 1.0 - /var/log/syslog\n2 20 1.0 abc /etc/hosts\n"
+
+        self.assertEqual(
+            120, script.estimate_payload(self.status, unit, baseline))
+        self.assertEqual(script.CHARM_PAYLOAD,
+                         script.estimate_payload(self.status, unit))
+        self.assertEqual(
+            [("machine", "other", "3"), ("proxy",)],
+            script._task_keys(self.juju, unit, "3/lxd/2", "other"))
+        direct = script.Juju(juju_ssh=False)
+        self.assertEqual([], script._task_keys(direct, unit, None))
+
+    def test_time_window(self):
+        """The units' archives are limited to the given time window."""
+        script.call.side_effect = self._call_side_effect
+        options = script.CollectOptions(jobs=1, since=100, until=200)
+
+        script.collect_logs(self.juju, self.status, options)
+
+        expected = script._format_tar_command(
+            "-cf", "/tmp/logs_haproxy-0.tar", 100, 200)
+        script.check_output.assert_any_call(
+            ["juju", "ssh", "haproxy/0", expected],
+            stderr=subprocess.STDOUT, env=None)
+
+    def test_unit_pipeline_order(self):
+        """
+        Each unit collects its "ps" output, then the memory footprint of the
+        host it runs on, then writes its manifest, before its tarball is
+        created and downloaded.
+        """
+        self.status = script.JujuStatus(self.juju, {
+            "applications": {
+                "postgresql": {
+                    "units": {"postgresql/0": {"machine": "1"}}}}})
+        self.hosts.append(script.JujuHost("1", "1.2.3.5"))
+        script.get_hosts.return_value = self.hosts[:]
+        steps = []
+        script.check_output.side_effect = (
+            lambda args, **kw: steps.append((args[2], args[3].split()[0])))
+        script._create_ps_mem_output_file.side_effect = (
+            lambda juju, host: steps.append((host.name, "ps_mem")))
+        script.call.side_effect = self._call_side_effect
+
+        script.collect_logs(self.juju, self.status, self.options)
+
+        unit_steps = [step for step in steps if step[0] == "postgresql/0"]
+        self.assertEqual(["ps", "sudo", "sudo", "sudo"],
+                         [step for _, step in unit_steps])
+        self.assertEqual(
+            steps.index(unit_steps[0]) + 1, steps.index(("1", "ps_mem")))
+        script._create_ps_mem_output_file.assert_has_calls(
+            [mock.call(self.juju, host) for host in self.hosts],
+            any_order=True)
+
+    def test_fetches_status_when_not_given(self):
+        """
+        collect_logs() takes its own status snapshot if none is given.
+        """
+        script.call.side_effect = self._call_side_effect
+        orig_get_status = script.get_status
+        script.get_status = mock.Mock(return_value=self.status)
+        try:
+            script.collect_logs(self.juju, options=self.options)
+        finally:
+            script.get_status = orig_get_status
+
+        script.get_units.assert_called_once_with(self.juju, self.status)
+        script.get_hosts.assert_called_once_with(self.juju, self.status)
+
+    def test_get_units_failure(self):
+        """
+        collect_logs() does not handle errors from get_units().
+        """
+        script.get_units.side_effect = FakeError()
+
+        with self.assertRaises(FakeError):
+            script.collect_logs(self.juju, self.status, self.options)
+
+        script.get_units.assert_called_once_with(self.juju, self.status)
+        script.check_output.assert_not_called()
+        script.call.assert_not_called()
+
+    def test_get_hosts_failure(self):
+        """
+        collect_logs() does not handle errors from get_hosts().
+        """
+        script.get_hosts.side_effect = FakeError()
 
         with self.assertRaises(FakeError):
-            script.collect_logs(self.juju)
+            script.collect_logs(self.juju, self.status, self.options)
 
-        script.get_units.assert_called_once_with(self.juju)
-        self.assertEqual(script.check_output.call_count, 2)
+        script.get_hosts.assert_called_once_with(self.juju, self.status)
+        script.check_output.assert_not_called()
         script.call.assert_not_called()
 
+    def test_check_output_failure(self):
+        """
+        An unexpected error from check_output() only fails the unit it
+        collects, and the other units are still collected.
+        """
+        script.check_output.side_effect = [mock.DEFAULT,
+                                           FakeError(),
+                                           ] + [mock.DEFAULT] * 100
+        script.call.side_effect = self._call_side_effect
+
+        stats = script.collect_logs(self.juju, self.status, self.options)
+
+        script.get_units.assert_called_once_with(self.juju, self.status)
+        states = [unit["state"] for unit in stats.units.values()]
+        self.assertEqual(1, states.count("failed"))
+        self.assertEqual(len(self.units), states.count("complete"))
+
     def test_call_failure(self):
         """
         collect_logs() does not handle errors from call().
         """
         def call_side_effect(cmd, env=None):
+            # The bootstrap machine, the largest, is collected first.
             # second use of call() for landscape-server/0
-            if script.call.call_count == 2:
+            if script.call.call_count == 5:
                 raise FakeError()
             # first use of call() for postgresql/0
-            if script.call.call_count == 3:
+            if script.call.call_count == 7:
                 raise FakeError()
             # all other uses of call() default to the normal side effect.
             return self._call_side_effect(cmd, env=env)
         script.call.side_effect = call_side_effect
 
-        script.collect_logs(self.juju)
+        script.collect_logs(self.juju, self.status, self.options)
 
-        script.get_units.assert_called_once_with(self.juju)
+        script.get_units.assert_called_once_with(self.juju, self.status)
         units = self.units + [script.JujuUnit("0", "1.2.3.3")]
-        self.assertEqual(script.check_output.call_count, len(units) * 3)
-        self.assertEqual(script.call.call_count, len(units) * 2 - 1)
+        self.assertEqual(script.check_output.call_count, len(units) * 4)
+        self.assertEqual(script.call.call_count, len(units) * 3 - 1)
         for unit in units:
             if unit.name != "0":
                 name = unit.name.replace("/", "-")
@@ -755,10 +2105,522 @@ class CollectLogsTestCase(_BaseTestCase):
             self.assertFalse(os.path.exists(filename))
 
 
+class StreamLogsTestCase(_BaseTestCase):
+
+    def setUp(self):
+        super(StreamLogsTestCase, self).setUp()
+        self.unit = script.JujuUnit("postgresql/0", "1.2.3.5")
+        self.source = os.path.join(self.cwd, "unit-root")
+        _create_file(os.path.join(self.source, "var/log/syslog"), "log")
+        self.remote = [
+            "sh", "-c", "tar -czf - -C {} var".format(self.source)]
+        self.juju.ssh_args = mock.Mock(return_value=self.remote)
+        os.chdir(self.tempdir)
+
+    def test_success(self):
+        """
+        stream_logs_from_unit() extracts the remote tar's output straight
+        into the unit's directory.
+        """
+        script.stream_logs_from_unit(self.juju, self.unit)
+
+        self.juju.ssh_args.assert_called_once_with(
+            self.unit, script._format_tar_command("-czf", "-"))
+        self.assertTrue(os.path.isfile("postgresql-0/var/log/syslog"))
+        self.assertEqual(["postgresql-0"], os.listdir(self.tempdir))
+
+    def test_null_input(self):
+        """The remote command's stdin is /dev/null, not ours."""
+        with mock.patch.object(
+                script, "Popen", wraps=subprocess.Popen) as popen:
+            script.stream_logs_from_unit(self.juju, self.unit)
+
+        stdin = popen.call_args_list[0][1]["stdin"]
+        self.assertEqual(os.devnull, stdin.name)
+        self.assertTrue(stdin.closed)
+        self.assertTrue(os.path.isfile("postgresql-0/var/log/syslog"))
+
+    def test_tar_warnings(self):
+        """A remote tar returning 1 is only a warning."""
+        self.remote[-1] += "; exit 1"
+
+        script.stream_logs_from_unit(self.juju, self.unit)
+
+        self.assertTrue(os.path.isfile("postgresql-0/var/log/syslog"))
+
+    def test_retry(self):
+        """Failed streams are retried from scratch."""
+        marker = os.path.join(self.cwd, "failed-once")
+        self.remote[-1] = (
+            "if [ ! -e {0} ]; then touch {0}; echo partial; exit 255; fi; "
+            "{1}").format(marker, self.remote[-1])
+
+        script.stream_logs_from_unit(self.juju, self.unit)
+
+        self.assertTrue(os.path.isfile("postgresql-0/var/log/syslog"))
+
+    def test_give_up(self):
+        """
+        After TAR_ATTEMPTS failures the unit is skipped, leaving no
+        directory behind.
+        """
+        attempts = os.path.join(self.cwd, "attempts")
+        self.remote[-1] = "echo >> {}; exit 2".format(attempts)
+
+        script.stream_logs_from_unit(self.juju, self.unit)
+
+        with open(attempts) as f:
+            self.assertEqual(script.TAR_ATTEMPTS, len(f.readlines()))
+        self.assertEqual([], os.listdir(self.tempdir))
+
+    def test_prefix(self):
+        """Without a bundle, the prefix is the directory extracted into."""
+        script.stream_logs_from_unit(self.juju, self.unit, prefix="inner")
+
+        self.assertTrue(os.path.isfile("inner/var/log/syslog"))
+        self.assertEqual(["inner"], os.listdir(self.tempdir))
+
+    def test_attempts(self):
+        """The command is only run the given number of times."""
+        attempts = os.path.join(self.cwd, "attempts")
+        self.remote[-1] = "echo >> {}; exit 2".format(attempts)
+
+        script.stream_logs_from_unit(self.juju, self.unit, attempts=1)
+
+        with open(attempts) as f:
+            self.assertEqual(1, len(f.readlines()))
+
+    def test_relay_errors(self):
+        """With relay_errors, the command's stderr goes to ours as is."""
+        self.remote[-1] = "echo inner log >&2; " + self.remote[-1]
+        errors = tempfile.TemporaryFile()
+        self.addCleanup(errors.close)
+        stderr = os.dup(2)
+        os.dup2(errors.fileno(), 2)
+        try:
+            script.stream_logs_from_unit(
+                self.juju, self.unit, relay_errors=True)
+        finally:
+            os.dup2(stderr, 2)
+            os.close(stderr)
+
+        errors.seek(0)
+        self.assertEqual(b"inner log\n", errors.read())
+        self.assertTrue(os.path.isfile("postgresql-0/var/log/syslog"))
+
+    def test_into_bundle(self):
+        """
+        With a bundle, the streamed archive's members are added to it under
+        the unit's directory, and nothing is extracted locally.
+        """
+        tarfile_path = os.path.join(self.cwd, "logs.tgz")
+        bundle = script.BundleWriter(tarfile_path)
+
+        script.stream_logs_from_unit(self.juju, self.unit, bundle)
+        bundle.close()
+
+        self.assertEqual([], os.listdir(self.tempdir))
+        self.assertEqual(
+            ["postgresql-0/var", "postgresql-0/var/log",
+             "postgresql-0/var/log/syslog"],
+            _bundle_names(tarfile_path))
+
+    def test_retry_into_bundle(self):
+        """
+        When a stream into the bundle is retried, the members that already
+        made it into the bundle aren't added again.
+        """
+        tarfile_path = os.path.join(self.cwd, "logs.tgz")
+        bundle = script.BundleWriter(tarfile_path)
+        marker = os.path.join(self.cwd, "failed-once")
+        self.remote[-1] = (
+            "if [ ! -e {0} ]; then touch {0}; {1}; exit 255; fi; "
+            "{1}").format(marker, self.remote[-1])
+
+        script.stream_logs_from_unit(self.juju, self.unit, bundle)
+        bundle.close()
+
+        self.assertEqual(
+            ["postgresql-0/var", "postgresql-0/var/log",
+             "postgresql-0/var/log/syslog"],
+            _bundle_names(tarfile_path))
+
+    @skipUnless(script._which("zstd"), "zstd isn't installed")
+    def test_zstd_into_bundle(self):
+        """zstd streams are decompressed on their way into the bundle."""
+        codec = script.CODECS["zstd"]
+        self.remote[-1] = "tar --use-compress-program=zstd -cf - -C {} var"\
+            .format(self.source)
+        tarfile_path = os.path.join(self.cwd, "logs.tgz")
+        bundle = script.BundleWriter(tarfile_path)
+
+        script.stream_logs_from_unit(self.juju, self.unit, bundle, codec)
+        bundle.close()
+
+        self.juju.ssh_args.assert_called_once_with(
+            self.unit, script._format_tar_command(
+                "--use-compress-program='zstd -q -T0' -cf", "-"))
+        self.assertEqual(
+            ["postgresql-0/var", "postgresql-0/var/log",
+             "postgresql-0/var/log/syslog"],
+            _bundle_names(tarfile_path))
+
+    def test_collect_unit_streams(self):
+        """
+        collect_unit() streams the logs when asked to, instead of creating
+        and downloading a tarball.
+        """
+        options = script.CollectOptions(stream=True)
+        with mock.patch.object(script, "_create_ps_output_file"), \
+                mock.patch.object(script, "_create_log_tarball") as create, \
+                mock.patch.object(script, "download_log_from_unit") as pull:
+            script.collect_unit(self.juju, self.unit, options=options)
+
+        create.assert_not_called()
+        pull.assert_not_called()
+        self.assertTrue(os.path.isfile("postgresql-0/var/log/syslog"))
+
+
+class SessionTestCase(_BaseTestCase):
+
+    def setUp(self):
+        super(SessionTestCase, self).setUp()
+        self.unit = script.JujuUnit("postgresql/0", "1.2.3.5")
+        self.root = os.path.join(self.cwd, "unit-root")
+        _create_file(os.path.join(self.root, "var/log/syslog"), "syslog")
+        _create_file(os.path.join(self.root, "var/log/old.log"), "old")
+        os.utime(os.path.join(self.root, "var/log/old.log"), (50, 50))
+        _create_file(os.path.join(self.root, "etc/hosts"), "hosts")
+        os.utime(os.path.join(self.root, "etc/hosts"), (50, 50))
+        _create_file(os.path.join(self.root, "var/log/secret/key"), "key")
+        os.symlink("syslog", os.path.join(self.root, "var/log/link"))
+        for name, value in [
+                ("LOGS", [self.root + "/var/log", self.root + "/etc/hosts",
+                          self.root + "/missing"]),
+                ("EXCLUDED", [self.root + "/var/log/secret"]),
+                ("ALWAYS_COLLECTED", [self.root + "/etc/*"]),
+                ("MANIFEST", self.root + "/var/log/manifest.txt"),
+                ("PS_OUTPUT", self.root + "/var/log/ps.txt"),
+                ("PS_MEM_OUTPUT", self.root + "/var/log/ps_mem.txt")]:
+            patcher = mock.patch.object(script, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.output = os.path.join(self.cwd, "session-output")
+        self.juju.ssh_args = mock.Mock(
+            return_value=["sh", "-c", "cat " + self.output])
+        os.chdir(self.tempdir)
+
+    def run_session(self, argv, ps=0, input=None):
+        """Run collect-logs --session, and return its exit code."""
+        stdin = io.BytesIO(json.dumps(input or {}).encode("utf-8"))
+        with open(self.output, "wb") as out, \
+                mock.patch.object(sys, "stdout", out), \
+                mock.patch.object(sys, "stdin", stdin), \
+                mock.patch.object(script, "_session_ps", return_value=ps):
+            return script.session_main(argv)
+
+    def read_output(self):
+        """Return the header and the archive's members in the output."""
+        with open(self.output, "rb") as f:
+            header = script._read_frame(f)
+            with closing(tarfile.open(fileobj=f, mode="r|*")) as tar:
+                members = dict(
+                    (member.name, tar.extractfile(member).read()
+                     if member.isreg() else member.linkname)
+                    for member in tar)
+        return header, members
+
+    def test_session_main(self):
+        """
+        collect-logs --session writes the manifest of the log files, then
+        a header framing how each step went and the archive of the files.
+        """
+        self.assertEqual(0, self.run_session(["--codec", "gzip"]))
+
+        header, members = self.read_output()
+        self.assertEqual({"ps": 0, "manifest": 0}, header["steps"])
+        self.assertEqual([], header["diagnostics"])
+        self.assertEqual("gzip", header["codec"])
+        root = self.root.lstrip("/")
+        self.assertEqual(
+            {root + "/etc/hosts": b"hosts",
+             root + "/var/log/link": "syslog",
+             root + "/var/log/old.log": b"old",
+             root + "/var/log/syslog": b"syslog"},
+            dict((name, data) for name, data in members.items()
+                 if not name.endswith("manifest.txt")))
+        manifest = script.parse_manifest(
+            members[root + "/var/log/manifest.txt"])
+        self.assertEqual(
+            sorted("/" + name for name in members
+                   if not name.endswith("manifest.txt")),
+            sorted(manifest))
+        st = os.lstat(os.path.join(self.root, "var/log/syslog"))
+        self.assertEqual(
+            (st.st_ino, st.st_size),
+            manifest[self.root + "/var/log/syslog"][:2])
+
+    def test_session_window(self):
+        """
+        Only the files modified within the window are collected, along with
+        the ALWAYS_COLLECTED ones.
+        """
+        self.run_session(["--codec", "none", "--since", "100"])
+
+        header, members = self.read_output()
+        self.assertEqual("none", header["codec"])
+        root = self.root.lstrip("/")
+        self.assertIn(root + "/etc/hosts", members)
+        self.assertIn(root + "/var/log/syslog", members)
+        self.assertNotIn(root + "/var/log/old.log", members)
+
+    def test_session_steps(self):
+        """Failed steps are recorded in the header, with their errors."""
+        with mock.patch.object(script, "ps_mem_report",
+                               side_effect=IOError("no /proc")):
+            self.run_session(["--ps-mem"], ps=2)
+
+        header, _ = self.read_output()
+        self.assertEqual({"ps": 2, "ps_mem": 1, "manifest": 0},
+                         header["steps"])
+        self.assertEqual(["ps_mem: no /proc"], header["diagnostics"])
+
+    def test_session_input(self):
+        """The baseline and known contents are read from stdin."""
+        syslog = os.path.join(self.root, "var/log/syslog")
+        st = os.lstat(syslog)
+        baseline = "{} {} {} - {}\n".format(
+            st.st_ino, st.st_size, script._manifest_mtime(st), syslog)
+        known = "3 {}\n".format(hashlib.sha1(b"old").hexdigest())
+
+        self.run_session(["--input"], input={"baseline": baseline,
+                                             "known": known})
+
+        _, members = self.read_output()
+        root = self.root.lstrip("/")
+        self.assertNotIn(root + "/var/log/syslog", members)
+        self.assertEqual(b"", members[root + "/var/log/old.log"])
+
+    def test_read_frame(self):
+        """A frame is read up to its end, and nothing more."""
+        stream = tempfile.TemporaryFile()
+        script._write_frame(stream, {"a": 1})
+        stream.write(b"rest")
+        stream.seek(0)
+        self.assertEqual({"a": 1}, script._read_frame(stream))
+        self.assertEqual(b"rest", stream.read())
+
+    def test_read_frame_missing(self):
+        """Streams not starting with a frame are errors."""
+        stream = tempfile.TemporaryFile()
+        stream.write(b"garbage\n")
+        stream.seek(0)
+        self.assertRaises(ValueError, script._read_frame, stream)
+
+    def test_collect_in_session(self):
+        """
+        collect_in_session() streams the unit's logs in one session, into
+        the bundle, and logs the steps that failed on the unit.
+        """
+        self.run_session(["--codec", "gzip"], ps=1)
+        bundle = script.BundleWriter(os.path.join(self.cwd, "logs.tgz"))
+        options = script.CollectOptions(since=100, max_file_size=10)
+
+        with mock.patch.object(script, "log") as log:
+            self.assertTrue(script.collect_in_session(
+                self.juju, self.unit, True, options, bundle))
+        bundle.close()
+
+        self.juju.ssh_args.assert_called_once_with(
+            self.unit, script._helper_command(
+                "--session --codec gzip --ps-mem --since 100 "
+                "--max-file-size 10"))
+        names = _bundle_names(os.path.join(self.cwd, "logs.tgz"))
+        self.assertIn("postgresql-0" + self.root + "/var/log/syslog", names)
+        log.warning.assert_called_once_with(
+            "ps failed on unit postgresql/0, returning 1")
+
+    def test_collect_in_session_uploads(self):
+        """collect-logs is copied to units that don't have it yet."""
+        self.run_session([])
+        self.juju.ssh_args.side_effect = [
+            ["sh", "-c", "exit 100"], ["sh", "-c", "cat " + self.output]]
+
+        with mock.patch.object(script, "upload_helper",
+                               return_value=True) as upload:
+            self.assertTrue(script.collect_in_session(self.juju, self.unit))
+
+        upload.assert_called_once_with(self.juju, self.unit)
+        self.assertTrue(os.path.isfile(os.path.join(
+            "postgresql-0" + self.root, "var/log/syslog")))
+
+    def test_collect_in_session_unavailable(self):
+        """
+        Units that can't run collect-logs are left to be collected step by
+        step, without retrying.
+        """
+        self.juju.ssh_args.return_value = ["sh", "-c", "exit 101"]
+
+        self.assertFalse(script.collect_in_session(self.juju, self.unit))
+
+        self.assertEqual(1, self.juju.ssh_args.call_count)
+        self.assertEqual([], os.listdir("."))
+
+    def test_options_args(self):
+        """The inner collect-logs collects units in one session too."""
+        options = script.CollectOptions(single_session=True)
+        self.assertEqual(["--single-session"], options.args())
+
+    def test_collect_unit(self):
+        """
+        With single_session, collect_unit() only falls back to the usual
+        steps when the unit can't run collect-logs.
+        """
+        options = script.CollectOptions(single_session=True)
+        host = script.JujuHost("1", "1.2.3.5")
+        for collected in (True, False):
+            with mock.patch.object(script, "collect_in_session",
+                                   return_value=collected) as session, \
+                    mock.patch.object(script, "_create_ps_output_file") \
+                    as ps, \
+                    mock.patch.object(script, "_create_log_tarball"), \
+                    mock.patch.object(script, "download_log_from_unit"), \
+                    mock.patch.object(script, "collect_ps_mem"), \
+                    mock.patch.object(script, "_create_manifest_file"):
+                script.collect_unit(self.juju, self.unit, host, options)
+            session.assert_called_once_with(
+                self.juju, self.unit, True, options, None, None)
+            self.assertEqual(not collected, ps.called)
+
+
+class ViaHostTestCase(_BaseTestCase):
+
+    def setUp(self):
+        super(ViaHostTestCase, self).setUp()
+        self.raw = {
+            "machines": {
+                "1": {"dns-name": "1.2.3.1", "containers": {
+                    "1/lxd/0": {"instance-id": "juju-1-lxd-0"},
+                    "1/lxd/1": {"instance-id": "juju-1-lxd-1"}}},
+                "2": {"dns-name": "1.2.3.2"},
+                "0": {"dns-name": "1.2.3.3"}},
+            "applications": {
+                "haproxy": {"units": {
+                    "haproxy/0": {"machine": "1/lxd/0",
+                                  "public-address": "1.2.3.10"},
+                    "haproxy/1": {"machine": "1/lxd/1",
+                                  "public-address": "1.2.3.11"}}},
+                "nova-compute": {"units": {
+                    "nova-compute/0": {"machine": "2",
+                                       "public-address": "1.2.3.2"}}}}}
+        self.status = script.JujuStatus(self.juju, self.raw)
+        self.host = script.JujuHost("1", "1.2.3.1")
+        self.units = [script.JujuUnit("haproxy/0", "1.2.3.10"),
+                      script.JujuUnit("haproxy/1", "1.2.3.11")]
+        self.containers = [(self.units[0], "juju-1-lxd-0"),
+                           (self.units[1], "juju-1-lxd-1")]
+        # The host's root filesystem, holding the containers'.
+        self.source = os.path.join(self.cwd, "host-root")
+        _create_file(os.path.join(
+            self.source, "var/lib/lxd/containers/juju-1-lxd-0/rootfs",
+            "var/log/syslog"), "syslog")
+        _create_file(os.path.join(self.source, "var/log/host.log"), "host")
+        self.juju.ssh_args = mock.Mock(return_value=[
+            "sh", "-c", "tar -czf - -C {} var".format(self.source)])
+        os.chdir(self.tempdir)
+
+    def test_get_containers(self):
+        """get_containers() maps container machines to instance ids."""
+        self.assertEqual(
+            {"1/lxd/0": "juju-1-lxd-0", "1/lxd/1": "juju-1-lxd-1"},
+            script.get_containers(self.juju, self.status))
+
+    def test_group_containers(self):
+        """Container units are grouped by host; others are left alone."""
+        units = self.status.units
+
+        grouped = script._group_containers(
+            units, self.status.unit_machines, self.status.containers,
+            self.status.hosts)
+
+        self.assertEqual(["1"], list(grouped))
+        self.assertItemsEqual(self.containers, grouped["1"])
+
+    def test_tar_command_roots(self):
+        """The log files are taken under each of the given roots."""
+        cmd = script._format_tar_command(
+            "-czf", "-", roots=["/var/lib/lxd/containers/juju-1-lxd-0/rootfs"])
+
+        self.assertIn(
+            " --exclude=/var/lib/lxd/containers/juju-1-lxd-0/rootfs"
+            "/var/lib/landscape/client/package/hash-id ", cmd)
+        self.assertIn(
+            "ls -1d /var/lib/lxd/containers/juju-1-lxd-0/rootfs/var/log "
+            "/var/lib/lxd/containers/juju-1-lxd-0/rootfs/etc/hosts ", cmd)
+
+    def test_collect_host_containers(self):
+        """
+        The host's archive is split into the units' directories, and the
+        units whose files weren't found are collected on their own.
+        """
+        filename = os.path.join(self.cwd, "logs.tgz")
+        bundle = script.BundleWriter(filename)
+        options = script.CollectOptions(via_host=True)
+
+        with mock.patch.object(script, "collect_unit") as collect_unit:
+            script.collect_host_containers(
+                self.juju, self.host, self.containers, options, bundle)
+        bundle.close()
+
+        self.assertEqual(
+            ["haproxy-0", "haproxy-0/var", "haproxy-0/var/log",
+             "haproxy-0/var/log/syslog"],
+            _bundle_names(filename))
+        collect_unit.assert_called_once_with(
+            self.juju, self.units[1], options=options, bundle=bundle)
+        self.juju.ssh_args.assert_called_once_with(
+            self.host, script._format_tar_command(
+                "-czf", "-", roots=sorted(
+                    template.format(instance_id)
+                    for template in script.CONTAINER_ROOTS
+                    for instance_id in ["juju-1-lxd-0", "juju-1-lxd-1"])))
+
+    def test_collect_logs(self):
+        """
+        With via_host, collect_logs() collects container units through
+        their host, and the other units directly.
+        """
+        options = script.CollectOptions(via_host=True)
+        bundle = mock.Mock()
+
+        with mock.patch.object(script, "collect_unit") as collect_unit, \
+                mock.patch.object(script, "collect_host_containers") as host, \
+                mock.patch.object(script, "collect_ps_mem"):
+            script.collect_logs(self.juju, self.status, options, bundle)
+
+        host.assert_called_once_with(
+            self.juju, self.host, mock.ANY, options, bundle)
+        self.assertItemsEqual(self.containers, host.call_args[0][2])
+        self.assertItemsEqual(
+            ["nova-compute/0", "0"],
+            [args[1].name for args, _ in collect_unit.call_args_list])
+
+    def test_collect_logs_without_bundle(self):
+        """Without a bundle, container units are collected directly."""
+        options = script.CollectOptions(via_host=True)
+
+        with mock.patch.object(script, "collect_unit") as collect_unit, \
+                mock.patch.object(script, "collect_host_containers") as host, \
+                mock.patch.object(script, "collect_ps_mem"):
+            script.collect_logs(self.juju, self.status, options)
+
+        host.assert_not_called()
+        self.assertEqual(4, collect_unit.call_count)
+
+
 class CollectInnerLogsTestCase(_BaseTestCase):
 
-    MOCKED = ("get_units", "check_output", "call", "check_call",
-              "upload_ps_mem")
+    MOCKED = ("get_units", "check_output", "call", "stream_logs_from_unit")
 
     def setUp(self):
         super(CollectInnerLogsTestCase, self).setUp()
@@ -770,11 +2632,22 @@ class CollectInnerLogsTestCase(_BaseTestCase):
             script.JujuUnit("haproxy/0", "1.2.3.7"),
             ]
         script.get_units.return_value = self.units[:]
-        script.check_output.return_value = "0\n"
+        script.check_output.return_value = self._probe_output("juju-2.1")
         script.call.return_value = 0
 
         os.chdir(self.tempdir)
 
+    def _probe_output(self, binary=None, home="0", proxy_ssh=True):
+        """Return what the inner probe outputs when binary works."""
+        lines = ["sudo: unable to resolve host landscape-0\r",
+                 "collect-logs-probe: home {}\r".format(home)]
+        if binary is not None:
+            lines.append("collect-logs-probe: juju {}\r".format(binary))
+            if not proxy_ssh:
+                lines.append("ERROR no such key\r")
+                lines.append("collect-logs-probe: proxy-ssh failed\r")
+        return "\n".join(lines).encode("utf-8")
+
     def assert_clean(self):
         """Ensure that collect_inner_logs cleaned up after itself."""
         self.assert_cwd(self.tempdir)
@@ -783,160 +2656,85 @@ class CollectInnerLogsTestCase(_BaseTestCase):
     def test_juju_2(self):
         """
         collect_inner_logs() finds the inner model and runs collect-logs
-        inside it.  The resulting tarball is downloaded, extracted, and
-        deleted.
-        """
-        def check_call_side_effect(cmd, env=None):
-            self.assertEqual(env, self.juju.env)
-            if script.check_call.call_count == 4:
-                self.assert_cwd(self.tempdir)
-                self._create_tempfile("inner-logs.tar.gz")
-            elif script.check_call.call_count == 5:
-                cwd = os.path.join(self.tempdir, "landscape-0-inner-logs")
-                self.assert_cwd(cwd)
-            return None
-        script.check_call.side_effect = check_call_side_effect
-
+        inside it, streaming the resulting bundle from its stdout.
+        """
         script.collect_inner_logs(self.juju)
 
         # Check get_units() calls.
-        script.get_units.assert_called_once_with(self.juju)
-        # Check check_output() calls.
-        expected = []
-        cmd = ("sudo JUJU_DATA=/var/lib/landscape/juju-homes/"
-               "`sudo ls -rt /var/lib/landscape/juju-homes/ | tail -1`"
-               " juju-2.1 model-config -m controller proxy-ssh=false")
-        expected.append(mock.call(["juju", "ssh", "landscape-server/0", cmd],
-                                  stderr=subprocess.STDOUT,
-                                  env=self.juju.env))
-        expected.append(mock.call(
+        script.get_units.assert_called_once_with(self.juju, None)
+        # Check the probe.
+        script.check_output.assert_called_once_with(
             ["juju", "ssh", "landscape-server/0",
-             "sudo ls -rt /var/lib/landscape/juju-homes/"],
-            env=self.juju.env))
-        self.assertEqual(script.check_output.call_count, len(expected))
-        script.check_output.assert_has_calls(expected, any_order=True)
-        # Check call() calls.
-        expected = [
-            mock.call(["juju", "ssh", "landscape-server/0",
-                       ("sudo JUJU_DATA=/var/lib/landscape/juju-homes/0 "
-                        "juju-2.1 status -m controller --format=yaml"),
-                       ], env=self.juju.env),
-            mock.call(["juju", "scp",
-                       os.path.join(os.path.dirname(__file__), "collect-logs"),
-                       "landscape-server/0:/tmp/collect-logs",
-                       ], env=self.juju.env),
-            mock.call(["juju", "ssh",
-                       "landscape-server/0",
-                       "sudo rm -rf /tmp/inner-logs.tar.gz",
-                       ], env=self.juju.env),
-            ]
-        self.assertEqual(script.call.call_count, len(expected))
-        script.call.assert_has_calls(expected, any_order=True)
-        # Check check_call() calls.
+             script.format_inner_probe()],
+            stderr=subprocess.STDOUT, env=self.juju.env)
+        # Check call() calls: the unit already has the helper.
+        script.call.assert_called_once_with(
+            ["juju", "ssh", "landscape-server/0",
+             "test -f " + script.remote_helper()], env=self.juju.env)
+        # Check the streamed bundle.
         cmd = ("sudo"
                " JUJU_DATA=/var/lib/landscape/juju-homes/0"
-               " /tmp/collect-logs --inner --juju juju-2.1"
+               " {} --inner --juju juju-2.1"
                " --model controller"
                " --cfgdir /var/lib/landscape/juju-homes/0"
-               " /tmp/inner-logs.tar.gz")
-        expected = [
-            mock.call(["juju", "ssh", "landscape-server/0", cmd],
-                      env=self.juju.env),
-            mock.call(["juju", "scp",
-                       "landscape-server/0:/tmp/inner-logs.tar.gz",
-                       os.path.join(self.tempdir, "inner-logs.tar.gz"),
-                       ], env=self.juju.env),
-            mock.call(["tar", "-zxf", self.tempdir + "/inner-logs.tar.gz"]),
-            ]
-        self.assertEqual(script.check_call.call_count, len(expected))
-        script.check_call.assert_has_calls(expected, any_order=True)
+               " -").format(script.remote_helper())
+        script.stream_logs_from_unit.assert_called_once_with(
+            self.juju, self.units[0], None, script.CODECS["gzip"],
+            command=cmd, prefix="landscape-0-inner-logs", attempts=1,
+            relay_errors=True)
         self.assert_clean()
 
     def test_juju_1(self):
         """
         collect_inner_logs() finds the inner model and runs collect-logs
-        inside it.  The resulting tarball is downloaded, extracted, and
-        deleted.
-        """
-        def check_call_side_effect(cmd, env=None):
-            self.assertEqual(env, self.juju.env)
-            if script.check_call.call_count == 4:
-                self.assert_cwd(self.tempdir)
-                self._create_tempfile("inner-logs.tar.gz")
-            elif script.check_call.call_count == 5:
-                cwd = os.path.join(self.tempdir, "landscape-0-inner-logs")
-                self.assert_cwd(cwd)
-            return None
-        script.check_call.side_effect = check_call_side_effect
-        script.call.side_effect = [1, 0, 0, 0]
-        err = subprocess.CalledProcessError(1, "...", "<output>")
-        script.check_output.side_effect = [err,
-                                           mock.DEFAULT,
-                                           mock.DEFAULT,
-                                           ]
+        inside it, streaming the resulting bundle from its stdout.
+        """
+        script.check_output.return_value = self._probe_output("juju", "3")
 
         script.collect_inner_logs(self.juju)
 
-        # Check get_units() calls.
-        script.get_units.assert_called_once_with(self.juju)
-        # Check check_output() calls.
-        expected = []
-        cmd = ("sudo JUJU_DATA=/var/lib/landscape/juju-homes/"
-               "`sudo ls -rt /var/lib/landscape/juju-homes/ | tail -1`"
-               " juju-2.1 model-config -m controller proxy-ssh=false")
-        expected.append(mock.call(["juju", "ssh", "landscape-server/0", cmd],
-                                  stderr=subprocess.STDOUT,
-                                  env=None))
-        cmd = ("sudo JUJU_HOME=/var/lib/landscape/juju-homes/"
-               "`sudo ls -rt /var/lib/landscape/juju-homes/ | tail -1`"
-               " juju set-env proxy-ssh=false")
-        expected.append(mock.call(["juju", "ssh", "landscape-server/0", cmd],
-                                  stderr=subprocess.STDOUT,
-                                  env=None))
-        expected.append(mock.call(
-            ["juju", "ssh", "landscape-server/0",
-             "sudo ls -rt /var/lib/landscape/juju-homes/"],
-            env=None))
-        self.assertEqual(script.check_output.call_count, len(expected))
-        script.check_output.assert_has_calls(expected, any_order=True)
-        # Check call() calls.
-        expected = [
-            mock.call(["juju", "ssh", "landscape-server/0",
-                       ("sudo JUJU_DATA=/var/lib/landscape/juju-homes/0 "
-                        "juju-2.1 status -m controller --format=yaml"),
-                       ], env=None),
-            mock.call(["juju", "ssh", "landscape-server/0",
-                       ("sudo -u landscape "
-                        "JUJU_HOME=/var/lib/landscape/juju-homes/0 "
-                        "juju status --format=yaml"),
-                       ], env=None),
-            mock.call(["juju", "scp",
-                       os.path.join(os.path.dirname(__file__), "collect-logs"),
-                       "landscape-server/0:/tmp/collect-logs",
-                       ], env=None),
-            mock.call(["juju", "ssh",
-                       "landscape-server/0",
-                       "sudo rm -rf /tmp/inner-logs.tar.gz",
-                       ], env=None),
-            ]
-        self.assertEqual(script.call.call_count, len(expected))
-        script.call.assert_has_calls(expected, any_order=True)
-        # Check check_call() calls.
+        self.assertEqual(script.check_output.call_count, 1)
+        self.assertEqual(script.call.call_count, 1)
+        # Check the streamed bundle.
         cmd = ("sudo -u landscape"
-               " JUJU_HOME=/var/lib/landscape/juju-homes/0"
-               " /tmp/collect-logs --inner --juju juju"
-               " --cfgdir /var/lib/landscape/juju-homes/0"
-               " /tmp/inner-logs.tar.gz")
-        expected = [
-            mock.call(["juju", "ssh", "landscape-server/0", cmd], env=None),
-            mock.call(["juju", "scp",
-                       "landscape-server/0:/tmp/inner-logs.tar.gz",
-                       os.path.join(self.tempdir, "inner-logs.tar.gz"),
-                       ], env=None),
-            mock.call(["tar", "-zxf", self.tempdir + "/inner-logs.tar.gz"]),
-            ]
-        self.assertEqual(script.check_call.call_count, len(expected))
-        script.check_call.assert_has_calls(expected, any_order=True)
+               " JUJU_HOME=/var/lib/landscape/juju-homes/3"
+               " {} --inner --juju juju"
+               " --cfgdir /var/lib/landscape/juju-homes/3"
+               " -").format(script.remote_helper())
+        script.stream_logs_from_unit.assert_called_once_with(
+            self.juju, self.units[0], None, script.CODECS["gzip"],
+            command=cmd, prefix="landscape-0-inner-logs", attempts=1,
+            relay_errors=True)
+        self.assert_clean()
+
+    def test_installs_helper(self):
+        """
+        collect-logs is installed as the helper on a landscape unit that
+        doesn't have it yet.
+        """
+        script.call.side_effect = lambda args, env: int("test -f" in args[-1])
+
+        with mock.patch.object(script, "upload_helper") as upload_helper:
+            upload_helper.return_value = True
+            script.collect_inner_logs(self.juju)
+
+        upload_helper.assert_called_once_with(self.juju, self.units[0])
+        self.assertEqual(script.stream_logs_from_unit.call_count, 1)
+
+    def test_helper_failure(self):
+        """
+        No inner logs are collected if collect-logs can't be installed on
+        the landscape unit.
+        """
+        script.call.return_value = 1
+
+        with mock.patch.object(script.log, "warning") as warning:
+            script.collect_inner_logs(self.juju)
+
+        warning.assert_called_with(
+            "Failed to set up collect-logs on unit landscape-server/0, "
+            "skipping inner logs")
+        script.stream_logs_from_unit.assert_not_called()
         self.assert_clean()
 
     def test_with_legacy_landscape_unit(self):
@@ -945,33 +2743,45 @@ class CollectInnerLogsTestCase(_BaseTestCase):
         """
         self.units[0] = script.JujuUnit("landscape/0", "1.2.3.4")
         script.get_units.return_value = self.units[:]
-        err = subprocess.CalledProcessError(1, "...", "<output>")
-        script.check_output.side_effect = [err,
-                                           mock.DEFAULT,
-                                           mock.DEFAULT,
-                                           ]
 
         script.collect_inner_logs(self.juju)
 
-        expected = []
-        cmd = ("sudo JUJU_DATA=/var/lib/landscape/juju-homes/"
-               "`sudo ls -rt /var/lib/landscape/juju-homes/ | tail -1`"
-               " juju-2.1 model-config -m controller proxy-ssh=false")
-        expected.append(mock.call(["juju", "ssh", "landscape/0", cmd],
-                                  stderr=subprocess.STDOUT,
-                                  env=None))
-        cmd = ("sudo JUJU_HOME=/var/lib/landscape/juju-homes/"
-               "`sudo ls -rt /var/lib/landscape/juju-homes/ | tail -1`"
-               " juju set-env proxy-ssh=false")
-        expected.append(mock.call(["juju", "ssh", "landscape/0", cmd],
-                                  stderr=subprocess.STDOUT,
-                                  env=None))
-        expected.append(mock.call(
-            ["juju", "ssh", "landscape/0",
-             "sudo ls -rt /var/lib/landscape/juju-homes/"],
-            env=None))
-        self.assertEqual(script.check_output.call_count, len(expected))
-        script.check_output.assert_has_calls(expected, any_order=True)
+        script.check_output.assert_called_once_with(
+            ["juju", "ssh", "landscape/0", script.format_inner_probe()],
+            stderr=subprocess.STDOUT, env=None)
+        self.assertEqual(
+            self.units[0], script.stream_logs_from_unit.call_args[0][1])
+        self.assert_clean()
+
+    def test_inner_model(self):
+        """The probe and the inner collect-logs use the given model."""
+        script.collect_inner_logs(self.juju, "landscape")
+
+        script.check_output.assert_called_once_with(
+            ["juju", "ssh", "landscape-server/0",
+             script.format_inner_probe("landscape")],
+            stderr=subprocess.STDOUT, env=None)
+        command = script.stream_logs_from_unit.call_args[1]["command"]
+        self.assertIn(" --model landscape ", command)
+
+    def test_probe_cached(self):
+        """The landscape unit is only probed once per run."""
+        script.collect_inner_logs(self.juju)
+        script.collect_inner_logs(self.juju)
+
+        self.assertEqual(script.check_output.call_count, 1)
+        self.assertEqual(script.stream_logs_from_unit.call_count, 2)
+
+    def test_bundle(self):
+        """
+        collect_inner_logs() streams the inner bundle into the given one.
+        """
+        bundle = mock.Mock()
+
+        script.collect_inner_logs(self.juju, bundle=bundle)
+
+        self.assertIs(
+            bundle, script.stream_logs_from_unit.call_args[0][2])
         self.assert_clean()
 
     def test_no_units(self):
@@ -982,10 +2792,10 @@ class CollectInnerLogsTestCase(_BaseTestCase):
 
         script.collect_inner_logs(self.juju)
 
-        script.get_units.assert_called_once_with(self.juju)
+        script.get_units.assert_called_once_with(self.juju, None)
         script.check_output.assert_not_called()
         script.call.assert_not_called()
-        script.check_call.assert_not_called()
+        script.stream_logs_from_unit.assert_not_called()
         self.assert_clean()
 
     def test_no_landscape_server_unit(self):
@@ -997,79 +2807,100 @@ class CollectInnerLogsTestCase(_BaseTestCase):
 
         script.collect_inner_logs(self.juju)
 
-        script.get_units.assert_called_once_with(self.juju)
+        script.get_units.assert_called_once_with(self.juju, None)
         script.check_output.assert_not_called()
         script.call.assert_not_called()
-        script.check_call.assert_not_called()
+        script.stream_logs_from_unit.assert_not_called()
         self.assert_clean()
 
     def test_no_juju_homes(self):
-        script.get_units.return_value = []
-        script.check_output.return_value = ""
+        """No inner logs are collected without a juju home."""
+        script.check_output.return_value = b""
 
         script.collect_inner_logs(self.juju)
 
-        script.get_units.assert_called_once_with(self.juju)
+        self.assertEqual(script.check_output.call_count, 1)
+        script.call.assert_not_called()
+        script.stream_logs_from_unit.assert_not_called()
+        self.assert_clean()
 
-        script.get_units.assert_called_once_with(self.juju)
-        script.check_output.assert_not_called()
+    def test_no_inner_model(self):
+        """
+        When neither Juju 2 nor Juju 1 finds the inner model, no inner logs
+        are collected.
+        """
+        script.check_output.return_value = self._probe_output()
+
+        script.collect_inner_logs(self.juju)
+
+        self.assertEqual(script.check_output.call_count, 1)
         script.call.assert_not_called()
-        script.check_call.assert_not_called()
+        script.stream_logs_from_unit.assert_not_called()
         self.assert_clean()
 
-    def test_get_units_failure(self):
+    def test_proxy_ssh_failure(self):
         """
-        collect_inner_logs() does not handle errors from get_units().
+        Failing to disable proxy-ssh is logged, and inner logs are still
+        collected.
         """
-        script.get_units.side_effect = FakeError()
+        script.check_output.return_value = self._probe_output(
+            "juju-2.1", proxy_ssh=False)
 
-        with self.assertRaises(FakeError):
+        with mock.patch.object(script.log, "warning") as warning:
             script.collect_inner_logs(self.juju)
 
-        self.assertEqual(script.get_units.call_count, 1)
-        script.check_output.assert_not_called()
+        warning.assert_any_call(
+            "Couldn't disable proxy-ssh in the inner environment, "
+            "collecting inner logs might fail.")
+        self.assertEqual(script.stream_logs_from_unit.call_count, 1)
+
+    def test_probe_failure(self):
+        """
+        When the probe fails, no inner logs are collected.
+        """
+        err = subprocess.CalledProcessError(1, "...", "<output>")
+        script.check_output.side_effect = err
+
+        script.collect_inner_logs(self.juju)
+
+        self.assertEqual(script.check_output.call_count, 1)
         script.call.assert_not_called()
-        script.check_call.assert_not_called()
-        self.assert_cwd(self.tempdir)
+        script.stream_logs_from_unit.assert_not_called()
         self.assert_clean()
 
-    def test_check_output_failure_1(self):
+    def test_get_units_failure(self):
         """
-        collect_inner_logs() does not handle non-CalledProcessError
-        errors when disabling the SSH proxy.
+        collect_inner_logs() does not handle errors from get_units().
         """
-        script.check_output.side_effect = FakeError()
+        script.get_units.side_effect = FakeError()
 
         with self.assertRaises(FakeError):
             script.collect_inner_logs(self.juju)
 
         self.assertEqual(script.get_units.call_count, 1)
-        self.assertEqual(script.check_output.call_count, 1)
+        script.check_output.assert_not_called()
         script.call.assert_not_called()
-        script.check_call.assert_not_called()
+        script.stream_logs_from_unit.assert_not_called()
         self.assert_cwd(self.tempdir)
         self.assert_clean()
 
-    def test_check_output_failure_2(self):
+    def test_check_output_failure(self):
         """
         collect_inner_logs() does not handle non-CalledProcessError
-        errors when verifying the inner model is bootstrapped.
+        errors when probing for the inner model.
         """
-        script.check_output.side_effect = [None,
-                                           FakeError(),
-                                           ]
+        script.check_output.side_effect = FakeError()
 
         with self.assertRaises(FakeError):
             script.collect_inner_logs(self.juju)
 
         self.assertEqual(script.get_units.call_count, 1)
-        self.assertEqual(script.check_output.call_count, 2)
+        self.assertEqual(script.check_output.call_count, 1)
         script.call.assert_not_called()
-        script.check_call.assert_not_called()
-        self.assert_cwd(self.tempdir)
+        script.stream_logs_from_unit.assert_not_called()
         self.assert_clean()
 
-    def test_call_juju2_failure(self):
+    def test_call_failure(self):
         """
         collect_inner_logs() does not handle errors from call().
         """
@@ -1078,144 +2909,1027 @@ class CollectInnerLogsTestCase(_BaseTestCase):
         with self.assertRaises(FakeError):
             script.collect_inner_logs(self.juju)
 
-        self.assertEqual(script.get_units.call_count, 1)
-        self.assertEqual(script.check_output.call_count, 2)
+        self.assertEqual(script.check_output.call_count, 1)
         self.assertEqual(script.call.call_count, 1)
-        script.check_call.assert_not_called()
-        self.assert_cwd(self.tempdir)
+        script.stream_logs_from_unit.assert_not_called()
         self.assert_clean()
 
-    def test_call_juju1_failure(self):
+    def test_stream_failure(self):
         """
-        collect_inner_logs() does not handle errors from call().
+        collect_inner_logs() does not handle errors when streaming the
+        bundle of the inner model.
         """
-        script.call.side_effect = [1,
-                                   FakeError(),
-                                   ]
+        script.stream_logs_from_unit.side_effect = FakeError()
 
         with self.assertRaises(FakeError):
             script.collect_inner_logs(self.juju)
 
         self.assertEqual(script.get_units.call_count, 1)
-        self.assertEqual(script.check_output.call_count, 2)
-        self.assertEqual(script.call.call_count, 2)
-        script.check_call.assert_not_called()
-        self.assert_cwd(self.tempdir)
+        self.assertEqual(script.check_output.call_count, 1)
+        self.assertEqual(script.call.call_count, 1)
+        self.assertEqual(script.stream_logs_from_unit.call_count, 1)
         self.assert_clean()
 
-    def test_call_juju2_nonzero_return(self):
+
+class InnerProbeTests(TestCase):
+
+    def setUp(self):
+        super(InnerProbeTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.homes = os.path.join(self.tmpdir, "juju-homes")
+        for name in ("1", "2", "backup"):
+            os.makedirs(os.path.join(self.homes, name))
+        patcher = mock.patch.object(
+            script, "LANDSCAPE_JUJU_HOME", self.homes)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bin = os.path.join(self.tmpdir, "bin")
+        os.mkdir(self.bin)
+        self.log = os.path.join(self.tmpdir, "log")
+        # sudo only drops its -u option, and env sets the juju vars.
+        self._write_program("sudo", '[ "$1" = -u ] && shift 2\nexec env "$@"')
+
+    def _write_program(self, name, body):
+        path = os.path.join(self.bin, name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\n{}\n".format(body))
+        os.chmod(path, 0o755)
+
+    def _write_juju(self, name, works):
+        """Write a juju that logs its args, and works or doesn't."""
+        self._write_program(
+            name, 'echo "{} $* $JUJU_DATA$JUJU_HOME" >> {}\nexit {}'.format(
+                name, self.log, 0 if works else 1))
+
+    def _probe(self, inner_model=script.DEFAULT_MODEL):
+        env = dict(os.environ, PATH=self.bin + os.pathsep + os.defpath)
+        output = subprocess.check_output(
+            ["sh", "-c", script.format_inner_probe(inner_model)], env=env)
+        return output.decode("utf-8")
+
+    def _read_log(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_juju_2(self):
         """
-        When no Juju 2 model is detected, Juju 1 is tried.
+        The probe finds the newest juju home, Juju 2 working on the inner
+        model, and disables proxy-ssh with it.
         """
-        script.call.side_effect = [1,
-                                   mock.DEFAULT,
-                                   mock.DEFAULT,
-                                   mock.DEFAULT,
-                                   ]
+        os.utime(os.path.join(self.homes, "1"), (0, 0))
+        self._write_juju("juju-2.1", True)
+        self._write_juju("juju", True)
 
-        script.collect_inner_logs(self.juju)
+        output = self._probe()
 
-        self.assertEqual(script.get_units.call_count, 1)
-        self.assertEqual(script.check_output.call_count, 2)
-        self.assertEqual(script.call.call_count, 4)
-        self.assertEqual(script.check_call.call_count, 3)
-        self.assert_clean()
+        inner = script.parse_inner_probe(output)
+        home = os.path.join(self.homes, "2")
+        self.assertEqual(
+            script.Juju("juju-2.1", model="controller", cfgdir=home,
+                        sudo=""),
+            inner)
+        self.assertEqual(
+            ["juju-2.1 status -m controller --format=yaml " + home,
+             "juju-2.1 model-config -m controller proxy-ssh=false " + home],
+            self._read_log())
 
-    def test_call_juju1_nonzero_return(self):
+    def test_juju_1(self):
+        """Juju 1 is tried when Juju 2 doesn't find the inner model."""
+        os.utime(os.path.join(self.homes, "2"), (0, 0))
+        self._write_juju("juju-2.1", False)
+        self._write_juju("juju", True)
+
+        output = self._probe("inner")
+
+        inner = script.parse_inner_probe(output, "inner")
+        home = os.path.join(self.homes, "1")
+        self.assertEqual(
+            script.Juju("juju", model="inner", cfgdir=home,
+                        sudo="landscape"),
+            inner)
+        self.assertEqual(
+            "juju set-env -e inner proxy-ssh=false " + home,
+            self._read_log()[-1])
+
+    def test_nothing_found(self):
+        """Without a working juju, the probe finds no inner model."""
+        self._write_juju("juju-2.1", False)
+        self._write_juju("juju", False)
+
+        self.assertIsNone(script.parse_inner_probe(self._probe()))
+
+    def test_no_homes(self):
+        """Without a juju home, the probe stops there."""
+        self._write_juju("juju-2.1", True)
+        for name in ("1", "2"):
+            os.rmdir(os.path.join(self.homes, name))
+
+        self.assertIsNone(script.parse_inner_probe(self._probe()))
+        self.assertFalse(os.path.exists(self.log))
+
+
+def _bundle_names(filename):
+    """Return the sorted names of the members of a bundle."""
+    with closing(tarfile.open(filename)) as bundle:
+        return sorted(bundle.getnames())
+
+
+def _make_archive(files, mode="w:gz", links=()):
+    """Return a file holding an archive of the given {name: data} files."""
+    archive = tempfile.TemporaryFile()
+    with closing(tarfile.open(fileobj=archive, mode=mode)) as tar:
+        for name, data in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        for name, target in links:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.LNKTYPE
+            info.linkname = target
+            tar.addfile(info)
+    archive.seek(0)
+    return archive
+
+
+class BundleWriterTests(TestCase):
+
+    def setUp(self):
+        super(BundleWriterTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, "logs.tgz")
+        self.bundle = script.BundleWriter(self.filename)
+
+    def test_add_archive(self):
+        """
+        add_archive() copies the archive's members, and their data, under
+        the given prefix.
+        """
+        archive = _make_archive(
+            {"var/log/syslog": b"syslog", "./etc/hosts": b"hosts"},
+            links=[("var/log/syslog.1", "var/log/syslog")])
+
+        self.bundle.add_archive("haproxy-0", archive)
+        self.bundle.close()
+
+        self.assertEqual(
+            ["haproxy-0/etc/hosts", "haproxy-0/var/log/syslog",
+             "haproxy-0/var/log/syslog.1"],
+            _bundle_names(self.filename))
+        with closing(tarfile.open(self.filename)) as bundle:
+            self.assertEqual(
+                b"syslog",
+                bundle.extractfile("haproxy-0/var/log/syslog").read())
+            link = bundle.getmember("haproxy-0/var/log/syslog.1")
+            self.assertEqual("haproxy-0/var/log/syslog", link.linkname)
+
+    def test_add_archive_routes(self):
+        """
+        With routes, the members under each path are copied under each of
+        its prefixes, and the others are left out.
+        """
+        archive = _make_archive(
+            {"var/lib/lxc/c1/rootfs/var/log/syslog": b"syslog",
+             "var/log/host.log": b"host"})
+
+        self.bundle.add_archive(
+            {"var/lib/lxc/c1/rootfs": ["haproxy-0", "haproxy-1"]}, archive)
+        self.bundle.close()
+
+        self.assertEqual(
+            ["haproxy-0/var/log/syslog", "haproxy-1/var/log/syslog"],
+            _bundle_names(self.filename))
+        with closing(tarfile.open(self.filename)) as bundle:
+            self.assertEqual(
+                b"syslog",
+                bundle.extractfile("haproxy-1/var/log/syslog").read())
+
+    def test_dedup(self):
         """
-        When no Juju 2 model is detected, Juju 1 is tried. When that
-        is not detected, no inner logs are collected.
+        Files whose content is already in the bundle are added as hard
+        links to it.
         """
-        script.call.side_effect = [1,
-                                   1,
-                                   ]
+        self.bundle.add_archive("unit-0", _make_archive({"a": b"same"}))
+        self.bundle.add_archive(
+            "unit-1", _make_archive({"a": b"same", "b": b"other"}))
+        self.bundle.close()
 
-        script.collect_inner_logs(self.juju)
+        with closing(tarfile.open(self.filename)) as bundle:
+            link = bundle.getmember("unit-1/a")
+            self.assertTrue(link.islnk())
+            self.assertEqual("unit-0/a", link.linkname)
+            self.assertTrue(bundle.getmember("unit-1/b").isreg())
+            self.assertEqual(b"same", bundle.extractfile(link).read())
 
-        self.assertEqual(script.get_units.call_count, 1)
-        self.assertEqual(script.check_output.call_count, 2)
-        self.assertEqual(script.call.call_count, 2)
-        script.check_call.assert_not_called()
-        self.assert_clean()
+    def test_no_dedup(self):
+        """With dedup off, every copy is stored."""
+        self.bundle.abort()
+        bundle = script.BundleWriter(self.filename, dedup=False)
+
+        bundle.add_archive("unit-0", _make_archive({"a": b"same"}))
+        bundle.add_archive("unit-1", _make_archive({"a": b"same"}))
+        bundle.close()
+
+        with closing(tarfile.open(self.filename)) as bundle:
+            self.assertTrue(bundle.getmember("unit-1/a").isreg())
+
+    def test_dedup_opt_in(self):
+        """Collections only deduplicate files with --dedup."""
+        parser = script.get_option_parser()
+
+        options = script.CollectOptions.from_args(
+            parser.parse_args(["logs.tgz"]))
+        self.assertFalse(options.dedup)
+        options = script.CollectOptions.from_args(
+            parser.parse_args(["--dedup", "logs.tgz"]))
+        self.assertTrue(options.dedup)
+        self.assertEqual(["--dedup"], options.args())
+
+    def test_known_contents(self):
+        """known_contents() lists the size and digest of each content."""
+        self.bundle.add_archive(
+            "unit-0", _make_archive({"a": b"same", "b": b"same", "c": b""}))
 
-    def test_call_all_nonzero_return(self):
+        self.assertEqual(
+            [(4, hashlib.sha1(b"same").hexdigest())],
+            self.bundle.known_contents())
+
+    def test_add_archive_skips_added(self):
         """
-        When no Juju 2 model is detected, Juju 1 is tried. When that
-        is not detected, no inner logs are collected.
+        add_archive() records the members it copied and skips the ones
+        already recorded.
         """
-        script.call.return_value = 1
+        added = set(["haproxy-0/var/log/syslog"])
+        archive = _make_archive(
+            {"var/log/syslog": b"syslog", "etc/hosts": b"hosts"})
 
-        script.collect_inner_logs(self.juju)
+        self.bundle.add_archive("haproxy-0", archive, added)
+        self.bundle.close()
 
-        self.assertEqual(script.get_units.call_count, 1)
-        self.assertEqual(script.check_output.call_count, 2)
-        self.assertEqual(script.call.call_count, 2)
-        script.check_call.assert_not_called()
-        self.assert_clean()
+        self.assertEqual(["haproxy-0/etc/hosts"],
+                         _bundle_names(self.filename))
+        self.assertEqual(
+            set(["haproxy-0/etc/hosts", "haproxy-0/var/log/syslog"]), added)
 
-    def test_check_call_failure_1(self):
+    def test_add_archive_truncated(self):
         """
-        collect_inner_logs() does not handle errors when running
-        collect-logs in the inner model.
+        A truncated archive raises an error, and the members read before
+        the truncation are kept in a valid bundle.
         """
-        script.check_call.side_effect = FakeError()
+        archive = _make_archive(
+            {"a/first": b"x" * 1024, "b/second": b"y" * 100000}, mode="w")
+        truncated = io.BytesIO(archive.read()[:60000])
+        added = set()
 
-        with self.assertRaises(FakeError):
-            script.collect_inner_logs(self.juju)
+        with self.assertRaises(script.ARCHIVE_ERRORS):
+            self.bundle.add_archive("haproxy-0", truncated, added)
+        self.bundle.close()
 
-        self.assertEqual(script.get_units.call_count, 1)
-        self.assertEqual(script.check_output.call_count, 2)
-        self.assertEqual(script.call.call_count, 3)
-        self.assertEqual(script.check_call.call_count, 1)
-        self.assert_clean()
+        self.assertEqual(["haproxy-0/a/first"], _bundle_names(self.filename))
+        self.assertEqual(set(["haproxy-0/a/first"]), added)
 
-    def test_check_call_failure_2(self):
-        """
-        collect_inner_logs() does not handle errors downloading the
-        collected logs from the inner model.
+    def test_abort(self):
+        """abort() removes the partly written bundle."""
+        self.bundle.abort()
+
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_uncompressed(self):
+        """With the "none" codec the bundle is a plain tar."""
+        self.bundle.abort()
+        bundle = script.BundleWriter(self.filename, script.CODECS["none"])
 
-        It does clean up, however.
+        bundle.add_archive("haproxy-0", _make_archive({"a": b"a"}))
+        bundle.close()
+
+        self.assertTrue(tarfile.is_tarfile(self.filename))
+        with closing(tarfile.open(self.filename, "r:")) as tar:
+            self.assertEqual(["haproxy-0/a"], tar.getnames())
+
+    def test_stream(self):
+        """
+        Given a fileobj, the bundle is written to it as a stream, which is
+        left open.
         """
-        script.check_call.side_effect = [None,
-                                         FakeError(),
-                                         ]
+        self.bundle.abort()
+        chunks = []
+        stream = mock.Mock(spec=["write", "flush", "close"])
+        stream.write.side_effect = chunks.append
+        bundle = script.BundleWriter("-", fileobj=stream)
 
-        with self.assertRaises(FakeError):
-            script.collect_inner_logs(self.juju)
+        bundle.add_archive("haproxy-0", _make_archive({"a": b"a"}))
+        bundle.close()
 
-        self.assertEqual(script.get_units.call_count, 1)
-        self.assertEqual(script.check_output.call_count, 2)
-        self.assertEqual(script.call.call_count, 3)
-        self.assertEqual(script.check_call.call_count, 2)
-        self.assert_clean()
+        data = b"".join(chunks)
+        self.assertEqual(b"\x1f\x8b", data[:2])
+        with closing(tarfile.open(fileobj=io.BytesIO(data))) as archive:
+            self.assertEqual(["haproxy-0/a"], archive.getnames())
+        stream.close.assert_not_called()
+        self.assertFalse(os.path.exists("-"))
 
-    def test_check_call_failure_3(self):
-        def check_call_side_effect(cmd, env=None):
-            self.assertEqual(env, self.juju.env)
-            if script.check_call.call_count == 3:
-                raise FakeError()
-            if script.check_call.call_count == 2:
-                self._create_tempfile("inner-logs.tar.gz")
-            return None
-        script.check_call.side_effect = check_call_side_effect
+    @skipUnless(script._which("zstd"), "zstd isn't installed")
+    def test_compressor_program(self):
+        """Codecs other than gzip compress the bundle in their program."""
+        self.bundle.abort()
+        bundle = script.BundleWriter(self.filename, script.CODECS["zstd"])
 
-        with self.assertRaises(FakeError):
-            script.collect_inner_logs(self.juju)
+        bundle.add_archive("haproxy-0", _make_archive({"a": b"a"}))
+        bundle.close()
 
-        self.assertEqual(script.get_units.call_count, 1)
-        self.assertEqual(script.check_output.call_count, 2)
-        self.assertEqual(script.call.call_count, 3)
-        self.assertEqual(script.check_call.call_count, 3)
-        self.assert_clean()
+        tar = subprocess.check_output(["zstd", "-d", "-c", self.filename])
+        with closing(tarfile.open(fileobj=io.BytesIO(tar))) as bundle:
+            self.assertEqual(["haproxy-0/a"], bundle.getnames())
 
 
-class BundleLogsTestCase(_BaseTestCase):
+class PullFileTestCase(_BaseTestCase):
 
-    MOCKED = ("call",)
+    MOCKED = ("call", "check_output")
+
+    def setUp(self):
+        super(PullFileTestCase, self).setUp()
+        self.juju = script.Juju(script.JUJU2, juju_ssh=True)
+        self.unit = script.JujuUnit("haproxy/0", "1.2.3.4")
+        patcher = mock.patch.object(script.time, "sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        script.check_output.return_value = b"10\n"
+        self.stats = script.RunStats()
+
+    def _pull(self):
+        """Pull the unit's tarball, counting in the summary."""
+        pulled = []
+        self.stats.run(["haproxy/0"], lambda: pulled.append(
+            script.pull_file(self.juju, self.unit, "/tmp/logs.tar.gz")))
+        return pulled[0]
+
+    def test_resume(self):
+        """
+        After the scp drops, the download continues from where it stopped.
+        """
+        def call(args, env=None, stdin=None, stdout=None):
+            if args[1] == "scp":
+                with open("logs.tar.gz", "wb") as f:
+                    f.write(b"0123")
+                return 1
+            stdout.write(b"456789")
+            return 0
+        script.call.side_effect = call
+
+        self.assertTrue(self._pull())
+
+        with open("logs.tar.gz", "rb") as f:
+            self.assertEqual(b"0123456789", f.read())
+        self.assertEqual(
+            ["juju-2.1", "ssh", "haproxy/0", "tail -c +5 /tmp/logs.tar.gz"],
+            script.call.call_args[0][0])
+        self.assertEqual(os.devnull, script.call.call_args[1]["stdin"].name)
+        self.sleep.assert_called_once_with(script.RETRY_DELAY)
+        self.assertEqual(
+            {"retries": 1, "bytes_resent": 0, "bytes_in": 10, "bytes_out": 0,
+             "throttled": 0},
+            self.stats.totals())
+
+    def test_replaced(self):
+        """A file smaller than what was copied is downloaded again."""
+        _create_file("logs.tar.gz", "0123456789abcdef")
+
+        def call(args, env=None, stdin=None, stdout=None):
+            if args[1] == "scp":
+                return 1
+            stdout.write(b"9876543210")
+            return 0
+        script.call.side_effect = call
+
+        self.assertTrue(self._pull())
+
+        self.assertEqual(
+            "tail -c +1 /tmp/logs.tar.gz", script.call.call_args[0][0][-1])
+        with open("logs.tar.gz", "rb") as f:
+            self.assertEqual(b"9876543210", f.read())
+        totals = self.stats.totals()
+        self.assertEqual(1, totals["retries"])
+        self.assertEqual(16, totals["bytes_resent"])
+
+    def test_backoff(self):
+        """The waits between attempts double, up to a maximum."""
+        script.call.return_value = 1
+        script.check_output.side_effect = script.CalledProcessError(255, "")
+
+        with mock.patch.object(script, "DOWNLOAD_ATTEMPTS", 7):
+            self.assertFalse(self._pull())
+
+        self.assertEqual([2, 4, 8, 16, 30, 30],
+                         [args[0] for args, _ in self.sleep.call_args_list])
+
+    def test_gone(self):
+        """There's no retrying once the file is gone from the unit."""
+        script.call.return_value = 1
+        script.check_output.return_value = b"missing\n"
+
+        self.assertFalse(self._pull())
+
+        self.assertEqual(
+            ["juju-2.1", "ssh", "haproxy/0",
+             "stat -c %s /tmp/logs.tar.gz 2>/dev/null || echo missing"],
+            script.check_output.call_args[0][0])
+        self.sleep.assert_called_once_with(script.RETRY_DELAY)
+        self.assertEqual(1, script.call.call_count)
+
+    def test_deadline(self):
+        """The pauses between attempts don't run past the deadline."""
+        script.call.return_value = 1
+        script.check_output.side_effect = script.CalledProcessError(255, "")
+        self.stats.deadline = time.time() + 3
+
+        self.assertFalse(self._pull())
+
+        self.assertEqual([2], [args[0] for args, _ in
+                               self.sleep.call_args_list])
+
+    def test_resent_members(self):
+        """Members streamed again by a retry are counted as resent."""
+        bundle = script.BundleWriter(os.path.join(self.cwd, "logs.tgz"))
+        added = set()
+
+        def add():
+            bundle.add_archive("unit-0", _make_archive({"a": b"1234"}), added)
+            bundle.add_archive(
+                "unit-0", _make_archive({"a": b"1234", "b": b"56"}), added)
+        self.stats.run(["unit-0"], add)
+        bundle.close()
+
+        self.assertEqual(4, self.stats.totals()["bytes_resent"])
+
+
+class ZipBundleWriterTests(TestCase):
+
+    def setUp(self):
+        super(ZipBundleWriterTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, "logs.zip")
+        self.bundle = script.ZipBundleWriter(self.filename)
+
+    def test_compressible(self):
+        """
+        Files named like compressed ones, or whose sample doesn't shrink,
+        aren't worth compressing.
+        """
+        text = b"Mar  1 12:00:00 host kernel: something happened\n" * 100
+        noise = os.urandom(len(text))
+
+        self.assertTrue(script._compressible("syslog", io.BytesIO(text)))
+        self.assertFalse(script._compressible("syslog.2.gz", io.BytesIO(text)))
+        self.assertFalse(script._compressible("noise", io.BytesIO(noise)))
+        self.assertFalse(script._compressible("empty", io.BytesIO(b"")))
+
+    def test_add_archive(self):
+        """
+        Compressible members are deflated, the others stored as-is, and
+        links become relative symlinks.
+        """
+        text = b"Mar  1 12:00:00 host kernel: something happened\n" * 100
+        archive = _make_archive(
+            {"var/log/syslog": text, "var/log/syslog.2.gz": b"rotated",
+             "var/crash/core": os.urandom(4096)},
+            links=[("var/log/syslog.1", "var/log/syslog")])
+
+        self.bundle.add_archive("haproxy-0", archive)
+        self.bundle.close()
+
+        with closing(zipfile.ZipFile(self.filename)) as bundle:
+            infos = dict((info.filename, info) for info in bundle.infolist())
+            self.assertEqual(
+                zipfile.ZIP_DEFLATED,
+                infos["haproxy-0/var/log/syslog"].compress_type)
+            self.assertEqual(
+                zipfile.ZIP_STORED,
+                infos["haproxy-0/var/log/syslog.2.gz"].compress_type)
+            self.assertEqual(
+                zipfile.ZIP_STORED,
+                infos["haproxy-0/var/crash/core"].compress_type)
+            self.assertEqual(text, bundle.read("haproxy-0/var/log/syslog"))
+            link = infos["haproxy-0/var/log/syslog.1"]
+            self.assertEqual(
+                stat.S_IFLNK, stat.S_IFMT(link.external_attr >> 16))
+            self.assertEqual(b"syslog", bundle.read(link))
+
+    def test_write_from_disk(self):
+        """
+        Without streaming, large members are written from a temporary file,
+        keeping their attributes.
+        """
+        text = b"Mar  1 12:00:00 host kernel: something happened\n" * 100
+        archive = _make_archive({"var/log/syslog": text})
+        spooled = os.path.join(self.tmpdir, "spooled.zip")
+
+        self.bundle.add_archive("unit-0", archive)
+        self.bundle.close()
+        archive.seek(0)
+        with mock.patch.object(script, "ZIP_STREAMING", False), \
+                mock.patch.object(script, "SPOOL_SIZE", 10):
+            bundle = script.ZipBundleWriter(spooled)
+            bundle.add_archive("unit-0", archive)
+            bundle.close()
+
+        with closing(zipfile.ZipFile(self.filename)) as expected, \
+                closing(zipfile.ZipFile(spooled)) as bundle:
+            name = "unit-0/var/log/syslog"
+            for attribute in ("date_time", "external_attr", "compress_type"):
+                self.assertEqual(
+                    getattr(expected.getinfo(name), attribute),
+                    getattr(bundle.getinfo(name), attribute))
+            self.assertEqual(text, bundle.read(name))
+
+    def test_dedup(self):
+        """Copies of identical files are symlinks to the first one."""
+        self.bundle.add_archive(
+            "unit-0", _make_archive({"var/log/a": b"same"}))
+        self.bundle.add_archive(
+            "unit-1", _make_archive({"var/log/a": b"same"}))
+        self.bundle.close()
+
+        with closing(zipfile.ZipFile(self.filename)) as bundle:
+            self.assertEqual(b"../../../unit-0/var/log/a",
+                             bundle.read("unit-1/var/log/a"))
+
+    def test_add_path(self):
+        """Directory trees are added with their files."""
+        tree = os.path.join(self.tmpdir, "tree")
+        os.makedirs(os.path.join(tree, "sub"))
+        with open(os.path.join(tree, "sub", "status.yaml"), "w") as f:
+            f.write("machines: {}\n")
+
+        self.bundle.add_path(tree, "extra")
+        self.bundle.close()
+
+        with closing(zipfile.ZipFile(self.filename)) as bundle:
+            self.assertEqual(
+                ["extra/", "extra/sub/", "extra/sub/status.yaml"],
+                sorted(bundle.namelist()))
+            self.assertEqual(b"machines: {}\n",
+                             bundle.read("extra/sub/status.yaml"))
+
+
+class DeltaTests(TestCase):
+
+    def setUp(self):
+        super(DeltaTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.root = os.path.join(self.tmpdir, "root")
+        os.mkdir(self.root)
+        self.manifest = os.path.join(self.tmpdir, "manifest.txt")
+        patcher = mock.patch.object(script, "MANIFEST", self.manifest)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write(self, name, data, mode="w"):
+        with open(os.path.join(self.root, name), mode) as f:
+            f.write(data)
+
+    def _write_manifest(self):
+        """Write the manifest of the root, as find does on the units."""
+        with open(self.manifest, "w") as f:
+            for name in sorted(os.listdir(self.root)):
+                path = os.path.join(self.root, name)
+                stat = os.lstat(path)
+                f.write("{} {} {!r} {}\n".format(
+                    stat.st_ino, stat.st_size, stat.st_mtime, path))
+
+    def _collect(self, filename, baseline=None, max_file_size=None):
+        """Run the agent and write its archive into a bundle."""
+        self._write_manifest()
+        argv = [self.manifest]
+        if max_file_size is not None:
+            argv = ["--max-file-size", str(max_file_size)] + argv
+        if baseline is not None:
+            with open(os.path.join(self.tmpdir, "baseline.txt"), "w") as f:
+                f.write(baseline)
+            argv = ["--baseline", f.name] + argv
+        out = io.BytesIO()
+        with mock.patch.object(sys, "stdout", out):
+            self.assertEqual(0, script.agent_main(argv))
+        bundle = script.BundleWriter(filename)
+        bundle.add_archive("unit-0", io.BytesIO(out.getvalue()))
+        bundle.close()
+
+    def _name(self, name):
+        return script._bundle_name("unit-0", os.path.join(self.root, name))
+
+    def _contents(self, filename):
+        """Return the {name: (data, pax offset)} of the bundle's files."""
+        contents = {}
+        with closing(tarfile.open(filename)) as tar:
+            for member in tar:
+                if member.name == script._bundle_name(
+                        "unit-0", self.manifest):
+                    continue
+                contents[member.name] = (
+                    tar.extractfile(member).read(),
+                    member.pax_headers.get(script.PAX_OFFSET))
+        return contents
+
+    def test_parse_manifest(self):
+        """Manifest lines are parsed, keeping the spaces in paths."""
+        entries = script.parse_manifest(
+            b"12 345 1488378600.5 /var/log/a file\nbogus\n")
+
+        self.assertEqual(
+            {"/var/log/a file": script.ManifestEntry(
+                12, 345, "1488378600.5", None)},
+            entries)
+
+    def test_delta(self):
+        """
+        The delta holds the new and changed files in full, and the bytes
+        appended to the others; layered on its baseline, it gives the
+        current files.
+        """
+        self._write("grown", "line 1\n")
+        self._write("same", "same\n")
+        self._write("rotated", "old\n")
+        self._write("rewritten", "short\n")
+        baseline = os.path.join(self.tmpdir, "baseline.tar.gz")
+        self._collect(baseline)
+        baselines = script.read_baseline(baseline)
+        self.assertEqual(["unit-0"], list(baselines))
+        self.assertEqual(4, len(baselines["unit-0"].splitlines()))
+
+        self._write("grown", "line 2\n", mode="a")
+        self._write("new", "new\n")
+        self._write("rotated.new", "rotated, longer\n")
+        os.rename(os.path.join(self.root, "rotated.new"),
+                  os.path.join(self.root, "rotated"))
+        self._write("rewritten", "longer, not appended\n", mode="r+")
+        delta = os.path.join(self.tmpdir, "delta.tar.gz")
+        self._collect(delta, baselines["unit-0"])
+
+        self.assertEqual(
+            {self._name("grown"): (b"line 2\n", "7"),
+             self._name("new"): (b"new\n", None),
+             self._name("rotated"): (b"rotated, longer\n", None),
+             self._name("rewritten"): (b"longer, not appended\n", None)},
+            self._contents(delta))
+
+        layered = os.path.join(self.tmpdir, "layered.tar.gz")
+        script.layer_bundle(baseline, delta, layered)
+
+        self.assertEqual(
+            {self._name("grown"): (b"line 1\nline 2\n", None),
+             self._name("same"): (b"same\n", None),
+             self._name("new"): (b"new\n", None),
+             self._name("rotated"): (b"rotated, longer\n", None),
+             self._name("rewritten"): (b"longer, not appended\n", None)},
+            self._contents(layered))
+
+    def test_max_file_size(self):
+        """
+        Files over the maximum size are cut down to their tail, next to a
+        sidecar recording what was dropped.
+        """
+        self._write("big", "0123456789")
+        self._write("small", "0123")
+        filename = os.path.join(self.tmpdir, "bundle.tar.gz")
+
+        self._collect(filename, max_file_size=4)
+
+        sidecar = self._name("big") + script.TRUNCATED_SUFFIX
+        contents = self._contents(filename)
+        self.assertEqual((b"6789", None), contents[self._name("big")])
+        self.assertEqual((b"0123", None), contents[self._name("small")])
+        self.assertEqual({"size": 10, "dropped": 6},
+                         json.loads(contents[sidecar][0].decode("utf-8")))
+
+    def test_max_file_size_delta(self):
+        """
+        Appends over the maximum size are cut down too, and the layered
+        bundle only keeps the latest sidecar.
+        """
+        self._write("big", "0123456789")
+        baseline = os.path.join(self.tmpdir, "baseline.tar.gz")
+        self._collect(baseline, max_file_size=4)
+        baselines = script.read_baseline(baseline)
+        self._write("big", "abcdef", mode="a")
+        delta = os.path.join(self.tmpdir, "delta.tar.gz")
+        self._collect(delta, baselines["unit-0"], max_file_size=5)
+        layered = os.path.join(self.tmpdir, "layered.tar.gz")
+
+        script.layer_bundle(baseline, delta, layered)
+
+        sidecar = self._name("big") + script.TRUNCATED_SUFFIX
+        contents = self._contents(layered)
+        self.assertEqual((b"bcdef", None), contents[self._name("big")])
+        self.assertEqual({"size": 16, "dropped": 11},
+                         json.loads(contents[sidecar][0].decode("utf-8")))
+
+    def test_parse_size(self):
+        """Sizes are in bytes, or with a K, M or G suffix."""
+        self.assertEqual(100, script.parse_size("100"))
+        self.assertEqual(2048, script.parse_size("2K"))
+        self.assertEqual(20 * 1024 ** 2, script.parse_size("20m"))
+        self.assertEqual(1024 ** 3, script.parse_size("1G"))
+        for value in ["", "big", "0", "-1K"]:
+            with self.assertRaises(script.ArgumentTypeError):
+                script.parse_size(value)
+
+    def test_known_contents(self):
+        """
+        Files whose content the collector already has are only referenced
+        by the agent, and linked to that content in the bundle.
+        """
+        self._write("hosts", "127.0.0.1 localhost\n")
+        self._write("other", "other\n")
+        self._write_manifest()
+        known = os.path.join(self.tmpdir, "known.txt")
+        digest = hashlib.sha1(b"127.0.0.1 localhost\n").hexdigest()
+        with open(known, "w") as f:
+            f.write("20 {}\n".format(digest))
+        out = io.BytesIO()
+        with mock.patch.object(sys, "stdout", out):
+            script.agent_main(["--known", known, self.manifest])
+        filename = os.path.join(self.tmpdir, "bundle.tar.gz")
+        bundle = script.BundleWriter(filename)
+        bundle.add_archive("unit-0", _make_archive(
+            {"etc/hosts": b"127.0.0.1 localhost\n"}))
+
+        bundle.add_archive("unit-1", io.BytesIO(out.getvalue()))
+        bundle.close()
+
+        with closing(tarfile.open(filename)) as tar:
+            member = tar.getmember(script._bundle_name(
+                "unit-1", os.path.join(self.root, "hosts")))
+            self.assertTrue(member.islnk())
+            self.assertEqual("unit-0/etc/hosts", member.linkname)
+            self.assertEqual(b"other\n", tar.extractfile(
+                script._bundle_name(
+                    "unit-1", os.path.join(self.root, "other"))).read())
+
+    def test_layer_links(self):
+        """
+        Hard links of the baseline whose target the delta replaces keep
+        their baseline content.
+        """
+        self._write("a", "same\n")
+        self._write("b", "same\n")
+        baseline = os.path.join(self.tmpdir, "baseline.tar.gz")
+        self._collect(baseline)
+        self._write("a", "changed\n", mode="r+")
+        delta = os.path.join(self.tmpdir, "delta.tar.gz")
+        self._collect(delta, script.read_baseline(baseline)["unit-0"])
+        layered = os.path.join(self.tmpdir, "layered.tar.gz")
+
+        script.layer_bundle(baseline, delta, layered)
+
+        self.assertEqual(
+            {self._name("a"): (b"changed\n", None),
+             self._name("b"): (b"same\n", None)},
+            self._contents(layered))
+
+    def test_encode(self):
+        """
+        With --encode, the agent gzips the files worth it one by one, and
+        the bundle gets them decoded.
+        """
+        text = "Mar  1 12:00:00 host kernel: something happened\n" * 100
+        self._write("syslog", text)
+        self._write("syslog.2.gz", "rotated")
+        self._write_manifest()
+        out = io.BytesIO()
+
+        with mock.patch.object(sys, "stdout", out):
+            self.assertEqual(0, script.agent_main(["--encode", self.manifest]))
+
+        out.seek(0)
+        with closing(tarfile.open(fileobj=out)) as tar:
+            encodings = dict(
+                (os.path.basename(member.name),
+                 member.pax_headers.get(script.PAX_ENCODING))
+                for member in tar)
+        self.assertEqual("gzip", encodings["syslog"])
+        self.assertIsNone(encodings["syslog.2.gz"])
+        filename = os.path.join(self.tmpdir, "bundle.tar.gz")
+        bundle = script.BundleWriter(filename)
+        bundle.add_archive("unit-0", io.BytesIO(out.getvalue()))
+        bundle.close()
+        self.assertEqual(
+            {self._name("syslog"): (text.encode("ascii"), None),
+             self._name("syslog.2.gz"): (b"rotated", None)},
+            self._contents(filename))
+
+    def test_excluded(self):
+        """The agent leaves out the EXCLUDED files."""
+        self._write("kept", "kept\n")
+        self._write("skipped", "skipped\n")
+        filename = os.path.join(self.tmpdir, "bundle.tar.gz")
+        excluded = [os.path.join(self.root, "skip*")]
+
+        with mock.patch.object(script, "EXCLUDED", excluded):
+            self._collect(filename)
+
+        self.assertEqual([self._name("kept")],
+                         list(self._contents(filename)))
+
+
+class CollectDeltaTestCase(_BaseTestCase):
+
+    MOCKED = ("call", "stream_logs_from_unit")
+
+    def setUp(self):
+        super(CollectDeltaTestCase, self).setUp()
+        self.juju = script.Juju(script.JUJU2, juju_ssh=True)
+        self.unit = script.JujuUnit("haproxy/0", "1.2.3.4")
+        self.bundle = mock.Mock(dedup=True)
+        self.bundle.known_contents.return_value = []
+        script.call.return_value = 0
+        patcher = mock.patch.object(
+            script, "_upload_path", side_effect=lambda name: "/tmp/up-" + name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.has_helper = mock.call(self.juju.ssh_args(
+            self.unit, "test -f " + script.remote_helper()),
+            env=self.juju.env)
+        os.chdir(self.tempdir)
+
+    def test_collect_delta(self):
+        """
+        The unit's baseline is copied to the unit for the helper to run as
+        the agent, and removed afterwards.
+        """
+        codec = script.CODECS["gzip"]
+
+        self.assertTrue(script.collect_with_agent(
+            self.juju, self.unit, self.bundle, codec, "baseline"))
+
+        baseline = "/tmp/up-baseline_haproxy-0.txt"
+        self.assertEqual(
+            [self.has_helper,
+             mock.call(self.juju.push_args(
+                 self.unit, "baseline_haproxy-0.txt", baseline),
+                 env=self.juju.env),
+             mock.call(self.juju.ssh_args(self.unit, "rm -f " + baseline),
+                       env=self.juju.env)],
+            script.call.call_args_list)
+        script.stream_logs_from_unit.assert_called_once_with(
+            self.juju, self.unit, self.bundle, codec,
+            command=script._helper_command("--agent --baseline {} {}".format(
+                baseline, script.MANIFEST)) + " | gzip -c")
+        self.assertEqual([], os.listdir("."))
+
+    def test_installs_helper(self):
+        """The helper is installed on units that don't have it yet."""
+        script.call.side_effect = lambda args, env: int("test -f" in args[-1])
+
+        self.assertTrue(script.collect_with_agent(
+            self.juju, self.unit, self.bundle, max_file_size=1024))
+
+        self.assertEqual(
+            ["test -f " + script.remote_helper(), "/tmp/up-helper",
+             script._format_install_command(
+                 "/tmp/up-helper", script.remote_helper(),
+                 script._helper_digest())],
+            [args[0][-1].split(":")[-1] if "scp" in args[0] else args[0][-1]
+             for args, _ in script.call.call_args_list])
+
+    def test_push_failure(self):
+        """If the agent can't be set up, the unit is collected in full."""
+        script.call.return_value = 1
+
+        self.assertFalse(script.collect_with_agent(
+            self.juju, self.unit, self.bundle, baseline="baseline"))
+
+        script.stream_logs_from_unit.assert_not_called()
+
+    def test_collect_unit_falls_back(self):
+        """collect_unit() collects in full when the delta can't be had."""
+        with mock.patch.object(script, "_run_cmd"), \
+                mock.patch.object(script, "collect_with_agent",
+                                  return_value=False) as delta:
+            script.collect_unit(
+                self.juju, self.unit, options=script.CollectOptions(
+                    stream=True, baseline="previous.tar.gz"),
+                bundle=self.bundle, baseline="baseline")
+
+        delta.assert_called_once_with(
+            self.juju, self.unit, self.bundle, mock.ANY, "baseline", None,
+            encode=False)
+        self.assertEqual(1, script.stream_logs_from_unit.call_count)
+
+    def test_stream_failure(self):
+        """
+        If the agent's stream fails, the unit is collected in full with
+        tar.
+        """
+        script.stream_logs_from_unit.return_value = False
+
+        self.assertFalse(script.collect_with_agent(
+            self.juju, self.unit, self.bundle, baseline="baseline"))
+        with mock.patch.object(script, "_run_cmd"), \
+                mock.patch.object(script, "_create_log_tarball") as tarball, \
+                mock.patch.object(script, "download_log_from_unit"):
+            script.collect_unit(
+                self.juju, self.unit,
+                options=script.CollectOptions(max_file_size=1024),
+                bundle=self.bundle)
+
+        tarball.assert_called_once_with(
+            self.juju, self.unit, mock.ANY, None, None)
+
+    def test_known_contents(self):
+        """The contents the bundle already has are passed to the agent."""
+        self.bundle.known_contents.return_value = [(4, "abcd"), (5, "ef01")]
+        pushed = {}
+
+        def call(args, env):
+            if "scp" in args:
+                pushed[args[-1]] = open(args[-2]).read()
+            return 0
+        script.call.side_effect = call
+
+        script.collect_with_agent(
+            self.juju, self.unit, self.bundle, max_file_size=1024)
+
+        known = "/tmp/up-known_haproxy-0.txt"
+        self.assertEqual("5 ef01\n4 abcd\n", pushed["haproxy/0:" + known])
+        command = script.stream_logs_from_unit.call_args[1]["command"]
+        self.assertIn(" --known {} ".format(known), command)
+        self.assertEqual([], os.listdir("."))
+
+    def test_known_limit(self):
+        """Units are only told about the KNOWN_LIMIT largest contents."""
+        self.bundle.known_contents.return_value = [
+            (4, "abcd"), (6, "2345"), (5, "ef01")]
+
+        with mock.patch.object(script, "KNOWN_LIMIT", 2):
+            self.assertEqual("6 2345\n5 ef01\n",
+                             script._format_known(self.bundle))
+
+    def test_max_file_size(self):
+        """Nothing is copied when truncating files without a baseline."""
+        codec = script.CODECS["none"]
+
+        script.collect_with_agent(
+            self.juju, self.unit, codec=codec, max_file_size=1024)
+
+        self.assertEqual([self.has_helper], script.call.call_args_list)
+        script.stream_logs_from_unit.assert_called_once_with(
+            self.juju, self.unit, None, codec,
+            command=script._helper_command(
+                "--agent --max-file-size 1024 " + script.MANIFEST))
+
+    def test_collect_unit_max_file_size(self):
+        """A maximum file size has the unit collected through the agent."""
+        with mock.patch.object(script, "_run_cmd"), \
+                mock.patch.object(script, "collect_with_agent",
+                                  return_value=True) as agent:
+            script.collect_unit(
+                self.juju, self.unit,
+                options=script.CollectOptions(max_file_size=1024))
+
+        agent.assert_called_once_with(
+            self.juju, self.unit, None, mock.ANY, None, 1024, encode=False)
+        script.stream_logs_from_unit.assert_not_called()
+
+    def test_collect_unit_zip(self):
+        """
+        Units are collected through the agent, with their files encoded
+        one by one, into zip bundles.
+        """
+        with mock.patch.object(script, "_run_cmd"), \
+                mock.patch.object(script, "collect_with_agent",
+                                  return_value=True) as agent:
+            script.collect_unit(
+                self.juju, self.unit, bundle=self.bundle,
+                options=script.CollectOptions(bundle_format="zip"))
+
+        agent.assert_called_once_with(
+            self.juju, self.unit, self.bundle, mock.ANY, None, None,
+            encode=True)
+
+    def test_encode(self):
+        """Encoding agents' streams aren't compressed as a whole."""
+        script.collect_with_agent(
+            self.juju, self.unit, self.bundle, script.CODECS["gzip"],
+            encode=True)
+
+        script.stream_logs_from_unit.assert_called_once_with(
+            self.juju, self.unit, self.bundle, script.CODECS["none"],
+            command=script._helper_command(
+                "--agent --encode " + script.MANIFEST))
+
+    def test_baseline_not_passed_on(self):
+        """The inner collect-logs doesn't get the baseline."""
+        options = script.CollectOptions(baseline="previous.tar.gz")
+
+        self.assertEqual([], options.args())
+
+
+class BundleLogsTestCase(_BaseTestCase):
 
     def setUp(self):
         """
-        bundle_logs() creates a tarball holding the files in the tempdir.
+        bundle_logs() adds the files in the tempdir to the bundle.
         """
         super(BundleLogsTestCase, self).setUp()
 
@@ -1236,49 +3950,78 @@ class BundleLogsTestCase(_BaseTestCase):
         self.extrafile = os.path.join(self.cwd, "spam.txt")
         _create_file(self.extrafile)
 
+        self.tarfile = os.path.join(self.cwd, "logs.tgz")
+        self.bundle = script.BundleWriter(self.tarfile)
+        self.expected = [
+            "bootstrap",
+            "bootstrap/var",
+            "bootstrap/var/lib",
+            "bootstrap/var/lib/juju",
+            "bootstrap/var/lib/juju/containers",
+            "bootstrap/var/lib/lxc",
+            "bootstrap/var/lib/lxc/deadbeef",
+            "bootstrap/var/lib/lxc/deadbeef/rootfs",
+            "bootstrap/var/lib/lxc/deadbeef/rootfs/var",
+            "bootstrap/var/lib/lxc/deadbeef/rootfs/var/log",
+            "bootstrap/var/lib/lxc/deadbeef/rootfs/var/log/syslog",
+            "bootstrap/var/log",
+            "bootstrap/var/log/juju",
+            "bootstrap/var/log/juju/all-machines.log",
+            "bootstrap/var/log/syslog",
+            "haproxy-0",
+            "haproxy-0/var",
+            "haproxy-0/var/log",
+            "haproxy-0/var/log/syslog",
+            "landscape-0-inner-logs",
+            "landscape-0-inner-logs/bootstrap",
+            "landscape-0-inner-logs/bootstrap/var",
+            "landscape-0-inner-logs/bootstrap/var/log",
+            "landscape-0-inner-logs/bootstrap/var/log/syslog",
+            "landscape-server-0",
+            "landscape-server-0/var",
+            "landscape-server-0/var/log",
+            "landscape-server-0/var/log/syslog",
+            "postgresql-0",
+            "postgresql-0/var",
+            "postgresql-0/var/log",
+            "postgresql-0/var/log/syslog",
+            "rabbitmq-server-0",
+            "rabbitmq-server-0/var",
+            "rabbitmq-server-0/var/log",
+            "rabbitmq-server-0/var/log/syslog",
+            ]
+
     def test_success_with_extra(self):
         """
-        bundle_logs() works if extra files are included.
+        bundle_logs() works if extra files are included, dropping the
+        leading "/" of their paths.
         """
-        tarfile = "/tmp/logs.tgz"
         extrafiles = [self.extrafile]
 
-        script.bundle_logs(self.tempdir, tarfile, extrafiles)
+        script.bundle_logs(self.tempdir, self.bundle, extrafiles)
 
-        script.call.assert_called_once_with(
-            ["tar",
-             "czf", tarfile,
-             "--transform", "s,{}/,,".format(self.tempdir[1:]),
-             os.path.join(self.tempdir, "bootstrap"),
-             os.path.join(self.tempdir, "haproxy-0"),
-             os.path.join(self.tempdir, "landscape-0-inner-logs"),
-             os.path.join(self.tempdir, "landscape-server-0"),
-             os.path.join(self.tempdir, "postgresql-0"),
-             os.path.join(self.tempdir, "rabbitmq-server-0"),
-             self.extrafile,
-             ],
-            )
+        self.assertEqual(
+            sorted(self.expected + [self.extrafile.lstrip("/")]),
+            _bundle_names(self.tarfile))
+
+    def test_relative_extra(self):
+        """
+        Extra files given with a relative path keep that path in the bundle.
+        """
+        os.chdir(self.cwd)
+
+        script.bundle_logs(self.tempdir, self.bundle, ["spam.txt"])
+
+        self.assertEqual(sorted(self.expected + ["spam.txt"]),
+                         _bundle_names(self.tarfile))
 
     def test_success_without_extra(self):
         """
         bundle_logs() works if there aren't any extra files.
         """
-        tarfile = "/tmp/logs.tgz"
+        script.bundle_logs(self.tempdir, self.bundle)
 
-        script.bundle_logs(self.tempdir, tarfile)
-
-        script.call.assert_called_once_with(
-            ["tar",
-             "czf", tarfile,
-             "--transform", "s,{}/,,".format(self.tempdir[1:]),
-             os.path.join(self.tempdir, "bootstrap"),
-             os.path.join(self.tempdir, "haproxy-0"),
-             os.path.join(self.tempdir, "landscape-0-inner-logs"),
-             os.path.join(self.tempdir, "landscape-server-0"),
-             os.path.join(self.tempdir, "postgresql-0"),
-             os.path.join(self.tempdir, "rabbitmq-server-0"),
-             ],
-            )
+        self.assertEqual(self.expected, _bundle_names(self.tarfile))
 
     def test_success_no_files(self):
         """
@@ -1286,36 +4029,14 @@ class BundleLogsTestCase(_BaseTestCase):
         """
         for filename in os.listdir(self.tempdir):
             shutil.rmtree(os.path.join(self.tempdir, filename))
-        tarfile = "/tmp/logs.tgz"
 
-        script.bundle_logs(self.tempdir, tarfile)
+        script.bundle_logs(self.tempdir, self.bundle)
 
-        script.call.assert_called_once_with(
-            ["tar",
-             "czf", tarfile,
-             "--transform", "s,{}/,,".format(self.tempdir[1:]),
-             ],
-            )
+        self.assertEqual([], _bundle_names(self.tarfile))
 
-    def test_call_failure(self):
+    def test_add_failure(self):
         """
-        bundle_logs() does not handle errors when creating the tarball.
+        bundle_logs() does not handle errors when adding to the bundle.
         """
-        script.call.side_effect = FakeError()
-        tarfile = "/tmp/logs.tgz"
-
-        with self.assertRaises(FakeError):
-            script.bundle_logs(self.tempdir, tarfile)
-
-        script.call.assert_called_once_with(
-            ["tar",
-             "czf", tarfile,
-             "--transform", "s,{}/,,".format(self.tempdir[1:]),
-             os.path.join(self.tempdir, "bootstrap"),
-             os.path.join(self.tempdir, "haproxy-0"),
-             os.path.join(self.tempdir, "landscape-0-inner-logs"),
-             os.path.join(self.tempdir, "landscape-server-0"),
-             os.path.join(self.tempdir, "postgresql-0"),
-             os.path.join(self.tempdir, "rabbitmq-server-0"),
-             ],
-            )
+        with self.assertRaises(OSError):
+            script.bundle_logs(self.tempdir, self.bundle, ["/nonexistent"])